@@ -0,0 +1,112 @@
+from game_logic import Game
+from bitboard_logic import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+import engine
+import setup_tools
+
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+# Static evaluation of many positions at once with NumPy. Positions are packed as
+# an (N, 64) array of piece codes (see piece_logic), one row per Game.squares or
+# Position.board, and every term of engine.evaluate_squares (material, piece-square
+# tables, mobility and king safety) is worked out for all rows together, giving the
+# same scores as the search uses.
+
+# The bitboards of engine's tables as (64, 64) matrices: row sq has a 1 in each column
+# the bitboard of sq has set
+def bitboard_matrix(table):
+    return np.array([[(table[sq] >> target) & 1 for target in range(64)] for sq in range(64)], dtype=np.float32)
+
+code_square_scores = np.array(engine.code_square_scores, dtype=np.int32)
+reach_matrices = {kind: bitboard_matrix(engine.reach_tables[kind]) for kind in (KNIGHT, BISHOP, ROOK, QUEEN)}
+shield_matrices = {colour: bitboard_matrix(engine.shield_tables[colour]) for colour in ("w", "b")}
+zone_matrix = bitboard_matrix(engine.king_zones)
+
+# Pack boards of piece codes (e.g. Position.board or Game.squares) into an (N, 64) array
+def pack_boards(boards):
+    return np.frombuffer(b"".join(bytes(board) for board in boards), dtype=np.uint8).reshape(-1, 64)
+
+# Pack positions (Game.snapshot) into codes for evaluate_batch, and whether black is
+# to move in each
+def pack_positions(positions):
+    return pack_boards(position.board for position in positions), \
+        np.array([position.active_player == "b" for position in positions], dtype=bool)
+
+# The scores of N boards of piece codes, as an (N,) array: from the point of view of
+# the player to move where black_to_move (an (N,) array) is given, otherwise white's
+def evaluate_batch(codes, black_to_move=None):
+    codes = np.asarray(codes, dtype=np.uint8).reshape(-1, 64)
+    scores = code_square_scores[codes, np.arange(64)].sum(axis=1, dtype=np.int64)
+    empty = (codes == 0).astype(np.float32)
+
+    # For each kind, (white pieces - black pieces) @ reach counts the pieces reaching each
+    # square, so the empty ones summed give the difference in mobility
+    for kind, reach in reach_matrices.items():
+        pieces = (codes == kind + 1).astype(np.float32) - (codes == kind + 9).astype(np.float32)
+        scores += engine.mobility_weights[kind] * np.rint(((pieces @ reach) * empty).sum(axis=1)).astype(np.int64)
+
+    white_king = (codes == KING + 1).astype(np.float32)
+    black_king = (codes == KING + 9).astype(np.float32)
+    white_pieces = ((codes >= KNIGHT + 1) & (codes <= QUEEN + 1)).astype(np.float32)
+    black_pieces = ((codes >= KNIGHT + 9) & (codes <= QUEEN + 9)).astype(np.float32)
+    shield = (((white_king @ shield_matrices["w"]) * (codes == PAWN + 1)).sum(axis=1)
+        - ((black_king @ shield_matrices["b"]) * (codes == PAWN + 9)).sum(axis=1))
+    attackers = (((black_king @ zone_matrix) * white_pieces).sum(axis=1)
+        - ((white_king @ zone_matrix) * black_pieces).sum(axis=1))
+    scores += engine.shield_weight * np.rint(shield).astype(np.int64)
+    scores += engine.attacker_weight * np.rint(attackers).astype(np.int64)
+
+    if black_to_move is not None: scores = np.where(black_to_move, -scores, scores)
+    return scores
+
+# Positions from random games from the start position, for benchmarking
+def random_positions(count, seed=0, backend="bitboard"):
+    rng = random.Random(seed)
+    game = Game(backend)
+    positions = []
+    while len(positions) < count:
+        moves = game.legal_moves()
+        if moves == [] or len(game.move_history) >= 200:
+            game = Game(backend)
+            continue
+        game.make_move(rng.choice(moves))
+        positions.append(game.snapshot())
+    return positions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched NumPy evaluation against one position at a time")
+    parser.add_argument("--positions", type=str, default=None,
+                        help="file of positions (one FEN per line); by default positions from random games")
+    parser.add_argument("--count", type=int, default=100000, help="number of random positions")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random games")
+    parser.add_argument("--batch", type=int, default=65536, help="positions per batch")
+    args = parser.parse_args()
+
+    if args.positions != None:
+        game = Game()
+        positions = []
+        for fen in setup_tools.read_fens(args.positions):
+            game.load_fen(fen)
+            positions.append(game.snapshot())
+    else:
+        positions = random_positions(args.count, args.seed)
+    codes, black_to_move = pack_positions(positions)
+
+    start = time.perf_counter()
+    single = [engine.evaluate_squares(position.board, position.active_player) for position in positions]
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = np.concatenate([evaluate_batch(codes[i:i + args.batch], black_to_move[i:i + args.batch])
+        for i in range(0, len(positions), args.batch)])
+    batch_seconds = time.perf_counter() - start
+
+    mismatches = int((batched != np.array(single)).sum())
+    print("{} positions, {} mismatches".format(len(positions), mismatches))
+    print("one at a time: {:.3f}s ({:.0f} positions/s)".format(single_seconds, len(positions) / single_seconds))
+    print("batched:       {:.3f}s ({:.0f} positions/s)".format(batch_seconds, len(positions) / batch_seconds))
+    if mismatches: sys.exit(1)
@@ -0,0 +1,195 @@
+from game_logic import Game, move_name
+import engine
+import book
+import setup_tools
+import profiling
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+# Runs engine self-play games, or engine analysis of a list of positions, across a
+# pool of worker processes. Each worker has its own Game and Engine (nothing is
+# shared between processes, and there is no GUI), and the results are written to a
+# JSONL file, one object per game or position, as each one finishes.
+
+# The engine of this worker process, made by init_worker
+worker_engine = None
+
+# Each worker maps the book itself; the pages are shared between processes by the OS.
+# With profile set, each result also has the worker's hot function counters for it.
+def init_worker(hash_mb, book_path=None, keys_path=None, profile=False):
+    global worker_engine
+    if profile: profiling.install()
+    opening_book = None
+    if book_path != None:
+        opening_book = book.PolyglotBook(book_path, book.load_keys(keys_path) if keys_path else book.default_keys)
+    worker_engine = engine.Engine(hash_mb, opening_book)
+
+def load_game(task):
+    game = Game(task["backend"])
+    if task["position"] != None: game.load_fen(task["position"])
+    return game
+
+# Parse a time control "base+increment" in seconds, e.g. "60+0.5"
+def parse_time_control(text):
+    base, _, increment = text.partition("+")
+    return float(base), float(increment or 0)
+
+# The search limits for one move. With a time control the move time comes from the
+# player's clock; otherwise it is the fixed movetime (if any).
+def search_limits(task, clock):
+    movetime = task["movetime"]
+    if task["time_control"] != None:
+        movetime = engine.allocate_time(clock, task["time_control"][1])
+    return task["depth"], movetime, task["nodes"]
+
+def play_game(task):
+    start = time.perf_counter()
+    profiling.reset()
+    try:
+        game = load_game(task)
+    except ValueError as e:
+        return bad_position(task, e)
+    rng = random.Random(task["seed"])
+    worker_engine.random.seed(task["seed"])
+    worker_engine.table.clear()
+
+    clocks = {"w": None, "b": None}
+    if task["time_control"] != None: clocks = {"w": task["time_control"][0], "b": task["time_control"][0]}
+    moves = []
+    nodes = 0
+    search_time = 0.0
+    result, reason = "1/2-1/2", None
+
+    while reason == None:
+        player = game.active_player
+        legal_moves = game.legal_moves()
+        if legal_moves == []:
+            if game.in_check(player):
+                result, reason = ("0-1" if player == "w" else "1-0"), "checkmate"
+            else:
+                reason = "stalemate"
+            break
+        if game.halfmove_clock >= 100: reason = "fifty-move rule"
+        elif game.repetitions() >= 3: reason = "repetition"
+        elif len(moves) >= task["max_plies"]: reason = "move limit"
+        if reason != None: break
+
+        # The first few moves are random (from the game's seed), so that games differ
+        if len(moves) < task["random_plies"]:
+            move = rng.choice(legal_moves)
+        else:
+            depth, movetime, node_limit = search_limits(task, clocks[player])
+            searched = worker_engine.search(game, depth, movetime, node_limit)
+            move = searched["move"]
+            nodes += searched["nodes"]
+            search_time += searched["time"]
+            if clocks[player] != None:
+                clocks[player] -= searched["time"]
+                if clocks[player] < 0:
+                    result, reason = ("0-1" if player == "w" else "1-0"), "time"
+                    break
+                clocks[player] += task["time_control"][1]
+
+        game.make_move(move)
+        moves.append(move_name(move))
+
+    return add_profile({"game": task["index"], "seed": task["seed"], "position": task["position"],
+        "result": result, "reason": reason, "plies": len(moves), "moves": moves,
+        "nodes": nodes, "nps": int(nodes / search_time) if search_time > 0 else 0,
+        "seconds": round(time.perf_counter() - start, 6)})
+
+def analyse_position(task):
+    start = time.perf_counter()
+    profiling.reset()
+    try:
+        game = load_game(task)
+    except ValueError as e:
+        return bad_position(task, e)
+    worker_engine.table.clear()
+    depth, movetime, node_limit = search_limits(task, None)
+    searched = worker_engine.search(game, depth, movetime, node_limit)
+    return add_profile({"index": task["index"], "position": task["position"], "move": searched["name"],
+        "score": searched["score"], "depth": searched["depth"], "pv": searched["pv"],
+        "nodes": searched["nodes"], "nps": searched["nps"],
+        "seconds": round(time.perf_counter() - start, 6)})
+
+# The result for a task whose position can't be loaded, so one bad FEN doesn't stop the run
+def bad_position(task, error):
+    return {"index": task["index"], "position": task["position"], "error": str(error)}
+
+def add_profile(result):
+    if profiling.installed: result["profile"] = profiling.report()
+    return result
+
+def make_tasks(args, positions):
+    tasks = []
+    count = args.games if args.mode == "games" else len(positions)
+    for i in range(count):
+        tasks.append({"index": i, "seed": args.seed + i, "backend": args.backend,
+            "position": positions[i % len(positions)] if positions else None,
+            "depth": args.depth, "movetime": args.movetime, "nodes": args.nodes,
+            "time_control": parse_time_control(args.tc) if args.tc != None else None,
+            "max_plies": args.max_plies, "random_plies": args.random_plies})
+    return tasks
+
+# Run the tasks over the pool, writing each result to out as soon as it arrives
+def run(args, out):
+    positions = setup_tools.read_fens(args.positions) if args.positions != None else []
+    if args.mode == "analyse" and positions == []:
+        raise ValueError("analyse needs --positions")
+    tasks = make_tasks(args, positions)
+    worker = play_game if args.mode == "games" else analyse_position
+
+    start = time.perf_counter()
+    tally = {}
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.hash, args.book, args.book_keys, args.profile)) as pool:
+        for result in pool.imap_unordered(worker, tasks):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if "error" in result: tally["error"] = tally.get("error", 0) + 1
+            elif args.mode == "games": tally[result["result"]] = tally.get(result["result"], 0) + 1
+    seconds = time.perf_counter() - start
+
+    summary = "{} {} in {:.2f}s ({:.2f}/s) with {} workers".format(len(tasks),
+        args.mode if args.mode == "games" else "positions", seconds, len(tasks) / seconds, args.workers)
+    if tally: summary += ": " + ", ".join("{} {}".format(k, tally[k]) for k in sorted(tally))
+    print(summary, file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run engine self-play games or position analysis across processes")
+    parser.add_argument("mode", choices=["games", "analyse"], help="play games, or analyse each of --positions")
+    parser.add_argument("--games", type=int, default=10, help="number of games to play")
+    parser.add_argument("--positions", type=str, default=None,
+                        help="file of positions (one FEN per line) to start games from or analyse")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game (game i uses seed + i)")
+    parser.add_argument("--random-plies", type=int, default=4, help="random moves at the start of each game")
+    parser.add_argument("--max-plies", type=int, default=300, help="moves before a game is called a draw")
+    parser.add_argument("--depth", type=int, default=64, help="maximum search depth per move")
+    parser.add_argument("--movetime", type=float, default=None, help="seconds per move")
+    parser.add_argument("--nodes", type=int, default=None, help="maximum nodes per move")
+    parser.add_argument("--tc", type=str, default=None, help="time control per game as base+increment seconds, e.g. 60+0.5")
+    parser.add_argument("--hash", type=float, default=16, help="transposition table size in MB per worker")
+    parser.add_argument("--book", type=str, default=None, help="Polyglot opening book for the engine")
+    parser.add_argument("--book-keys", type=str, default=None, help="file of the 781 Polyglot keys for --book")
+    parser.add_argument("--backend", type=str, default="bitboard", choices=["mailbox", "bitboard"],
+                        help="move generation backend")
+    parser.add_argument("--profile", action="store_true",
+                        help="add call counts and times of the hot functions (see profiling.py) to each result")
+    parser.add_argument("--output", type=str, default="-", help="JSONL file to write results to (default stdout)")
+    args = parser.parse_args()
+
+    if args.movetime == None and args.nodes == None and args.tc == None and args.depth == 64:
+        args.depth = 2
+
+    if args.output == "-":
+        run(args, sys.stdout)
+    else:
+        with open(args.output, "w") as out:
+            run(args, out)
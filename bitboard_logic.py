@@ -0,0 +1,222 @@
+# Bitboard move generation backend.
+# Each bitboard is a 64-bit integer with one bit per square, where square = r*8 + c,
+# so bit 0 is cells[0][0] (black's back rank, left) and bit 63 is cells[7][7].
+# White pawns move towards row 0 (down the square numbers), black pawns towards row 7.
+
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+# Kind of each piece, keyed by its white glyph (see piece_logic)
+piece_kinds = {"♙": PAWN, "♘": KNIGHT, "♗": BISHOP, "♖": ROOK, "♕": QUEEN, "♔": KING}
+
+FULL = (1 << 64) - 1
+FILE_A = sum(1 << (r*8) for r in range(8))
+FILE_H = FILE_A << 7
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ FILE_H
+ROWS = [0xFF << (r*8) for r in range(8)]
+
+# Moves are encoded as from | to << 6 | promotion << 12 | flags << 15, where
+# promotion is 0 for none or the kind (KNIGHT..QUEEN) a pawn promotes to, and
+# flags mark the moves which need more than moving one piece (see Game.make_move).
+PROMOTIONS = (QUEEN, ROOK, BISHOP, KNIGHT)
+DOUBLE_PUSH, EN_PASSANT, CASTLE = 1, 2, 4
+
+# Sliding directions as (dr, dc). Rays in the first four run towards higher
+# square numbers, so their nearest blocker is the lowest set bit; the last four
+# run towards lower square numbers, so their nearest blocker is the highest set bit.
+ROOK_DIRECTIONS = [(0,1), (1,0)], [(0,-1), (-1,0)]
+BISHOP_DIRECTIONS = [(1,1), (1,-1)], [(-1,-1), (-1,1)]
+
+def _square_table(offsets):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        bb = 0
+        for dr, dc in offsets:
+            if 0 <= r+dr < 8 and 0 <= c+dc < 8: bb |= 1 << ((r+dr)*8 + c+dc)
+        table.append(bb)
+    return table
+
+def _ray_table(dr, dc):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        bb = 0
+        r, c = r+dr, c+dc
+        while 0 <= r < 8 and 0 <= c < 8:
+            bb |= 1 << (r*8 + c)
+            r, c = r+dr, c+dc
+        table.append(bb)
+    return table
+
+KNIGHT_ATTACKS = _square_table([[1,-2], [1,2], [2,-1], [2,1], [-1,-2], [-1,2], [-2,-1], [-2,1]])
+KING_ATTACKS = _square_table([[1,0], [-1,0], [0,1], [0,-1], [1,1], [-1,-1], [1,-1], [-1,1]])
+PAWN_ATTACKS = {"w": _square_table([[-1,-1], [-1,1]]), "b": _square_table([[1,-1], [1,1]])}
+
+ROOK_RAYS = ([_ray_table(*d) for d in ROOK_DIRECTIONS[0]], [_ray_table(*d) for d in ROOK_DIRECTIONS[1]])
+BISHOP_RAYS = ([_ray_table(*d) for d in BISHOP_DIRECTIONS[0]], [_ray_table(*d) for d in BISHOP_DIRECTIONS[1]])
+
+def _slider_attacks(rays, sq, occupied):
+    attacks = 0
+    for ray in rays[0]:
+        bb = ray[sq]
+        blockers = bb & occupied
+        if blockers: bb ^= ray[(blockers & -blockers).bit_length() - 1]
+        attacks |= bb
+    for ray in rays[1]:
+        bb = ray[sq]
+        blockers = bb & occupied
+        if blockers: bb ^= ray[blockers.bit_length() - 1]
+        attacks |= bb
+    return attacks
+
+def rook_attacks(sq, occupied):
+    return _slider_attacks(ROOK_RAYS, sq, occupied)
+
+def bishop_attacks(sq, occupied):
+    return _slider_attacks(BISHOP_RAYS, sq, occupied)
+
+def queen_attacks(sq, occupied):
+    return _slider_attacks(ROOK_RAYS, sq, occupied) | _slider_attacks(BISHOP_RAYS, sq, occupied)
+
+def squares(bb):
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+class Bitboards:
+    def __init__(self):
+        self.pieces = {"w": [0]*6, "b": [0]*6}
+        self.occupied = {"w": 0, "b": 0}
+
+    # Build the bitboards from the cells of a Game
+    def load(self, board):
+        self.__init__()
+        for row in board.cells:
+            for cell in row:
+                if cell.piece != None: self.set_square(cell.location, None, cell.piece)
+
+    # Called by Game.set_piece whenever the contents of a cell change
+    def set_square(self, location, old_piece, piece):
+        bit = 1 << (location[0]*8 + location[1])
+        if old_piece != None:
+            self.pieces[old_piece.colour][piece_kinds[old_piece.name["w"]]] &= ~bit
+            self.occupied[old_piece.colour] &= ~bit
+        if piece != None:
+            self.pieces[piece.colour][piece_kinds[piece.name["w"]]] |= bit
+            self.occupied[piece.colour] |= bit
+
+    def attacks(self, kind, colour, sq, occupied):
+        if kind == PAWN: return PAWN_ATTACKS[colour][sq]
+        elif kind == KNIGHT: return KNIGHT_ATTACKS[sq]
+        elif kind == BISHOP: return bishop_attacks(sq, occupied)
+        elif kind == ROOK: return rook_attacks(sq, occupied)
+        elif kind == QUEEN: return queen_attacks(sq, occupied)
+        else: return KING_ATTACKS[sq]
+
+    def pawn_pushes(self, colour, sq, empty):
+        if colour == "w":
+            single = (1 << sq >> 8) & empty
+            double = ((single & ROWS[5]) >> 8) & empty
+        else:
+            single = (1 << sq << 8) & empty
+            double = ((single & ROWS[2]) << 8) & empty
+        return single | double
+
+    # Destinations of the piece's ordinary moves (no castling or en passant) as a bitboard
+    def piece_targets(self, piece):
+        sq = piece.location[0]*8 + piece.location[1]
+        kind = piece_kinds[piece.name["w"]]
+        own = self.occupied[piece.colour]
+        enemy = self.occupied["b" if piece.colour == "w" else "w"]
+        if kind == PAWN:
+            return (PAWN_ATTACKS[piece.colour][sq] & enemy) | self.pawn_pushes(piece.colour, sq, FULL ^ (own | enemy))
+        return self.attacks(kind, piece.colour, sq, own | enemy) & ~own
+
+    # The same moves as a list of [dr, dc] offsets, as returned by Piece.get_moves
+    def piece_moves(self, piece, moves=None):
+        if moves == None: moves = []
+        r, c = piece.location[0], piece.location[1]
+        for sq in squares(self.piece_targets(piece)):
+            moves.append([sq // 8 - r, sq % 8 - c])
+        return moves
+
+    # All pseudo-legal moves for one side, encoded as above. Castling is left to
+    # King.castling_moves; en passant is included if ep_square (the square a pawn
+    # skipped over on the previous move) is given.
+    def generate_moves(self, colour, ep_square=None):
+        moves = []
+        append = moves.append
+        pieces = self.pieces[colour]
+        own = self.occupied[colour]
+        enemy = self.occupied["b" if colour == "w" else "w"]
+        occupied = own | enemy
+        targets = FULL ^ own
+
+        for kind, table in ((KNIGHT, KNIGHT_ATTACKS), (KING, KING_ATTACKS)):
+            bb = pieces[kind]
+            while bb:
+                lsb = bb & -bb
+                bb ^= lsb
+                frm = lsb.bit_length() - 1
+                att = table[frm] & targets
+                while att:
+                    to = att & -att
+                    att ^= to
+                    append(frm | (to.bit_length() - 1) << 6)
+
+        for kind, rays in ((BISHOP, (BISHOP_RAYS,)), (ROOK, (ROOK_RAYS,)), (QUEEN, (ROOK_RAYS, BISHOP_RAYS))):
+            bb = pieces[kind]
+            while bb:
+                lsb = bb & -bb
+                bb ^= lsb
+                frm = lsb.bit_length() - 1
+                att = 0
+                for ray_set in rays:
+                    att |= _slider_attacks(ray_set, frm, occupied)
+                att &= targets
+                while att:
+                    to = att & -att
+                    att ^= to
+                    append(frm | (to.bit_length() - 1) << 6)
+
+        # Pawns are done set-wise: shift every pawn at once, then recover the origin from the shift
+        pawns = pieces[PAWN]
+        empty = FULL ^ occupied
+        ep_bit = 0
+        if ep_square != None: ep_bit = 1 << ep_square
+        captures = enemy | ep_bit
+        if colour == "w":
+            single = (pawns >> 8) & empty
+            double = ((single & ROWS[5]) >> 8) & empty
+            shifts = ((single, 8, 0), (double, 16, DOUBLE_PUSH << 15),
+                ((pawns & NOT_FILE_A) >> 9 & captures, 9, 0), ((pawns & NOT_FILE_H) >> 7 & captures, 7, 0))
+            last_row = ROWS[0]
+        else:
+            single = (pawns << 8) & empty
+            double = ((single & ROWS[2]) << 8) & empty
+            shifts = ((single, -8, 0), (double, -16, DOUBLE_PUSH << 15),
+                ((pawns & NOT_FILE_A) << 7 & captures, -7, 0), ((pawns & NOT_FILE_H) << 9 & captures, -9, 0))
+            last_row = ROWS[7]
+
+        for bb, shift, flags in shifts:
+            # Only captures can reach the en passant square
+            if bb & ep_bit:
+                bb ^= ep_bit
+                append((ep_square + shift) | ep_square << 6 | EN_PASSANT << 15)
+            promotions = bb & last_row
+            bb ^= promotions
+            while bb:
+                to = bb & -bb
+                bb ^= to
+                to = to.bit_length() - 1
+                append((to + shift) | to << 6 | flags)
+            while promotions:
+                to = promotions & -promotions
+                promotions ^= to
+                to = to.bit_length() - 1
+                for kind in PROMOTIONS:
+                    append((to + shift) | to << 6 | kind << 12)
+
+        return moves
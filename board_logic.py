@@ -1,27 +1,46 @@
-from piece_logic import *
-import tkinter as tk
+from game_logic import Game, promotion_pieces
+import engine
+import tablebase
+import profiling
 
+import tkinter as tk
+import queue
+
+# The tkinter view of a Game. All of the rules live in game_logic; the Board
+# only draws the cells, turns clicks into moves, and listens for changes.
+# Changed cells are collected and redrawn together once per turn of the event
+# loop (see flush), so a move, or a jump through the history, draws each cell at most once.
+# The engine thinks in a background thread on its own copy of the game, and its move
+# is picked up by polling from the event loop, so the window stays responsive.
 class Cell:
-    def __init__(self, location, widget=None, piece=None):
+    __slots__ = ("location", "widget", "text", "orig_colour", "prev_colour")
+
+    def __init__(self, location, widget=None):
         self.location = location
         self.widget = widget
-        self.piece = piece
+        self.text = ""
+        self.orig_colour = None
+        self.prev_colour = None
 
-    def __str__(self):
-        if self.piece == None: return ""
-        else: return self.piece.name[self.piece.colour]
+    # Only touch the widget if the text has changed; tkinter redraws it when the event loop is next idle
+    def update_entry(self, text):
+        if text != self.text:
+            self.widget["text"] = text
+            self.text = text
 
-    def update_entry(self):
-        self.widget["text"] = str(self)
-        self.widget.update()
+    def set_colour(self, colour):
+        if self.widget["bg"] != colour: self.widget["bg"] = colour
 
 class Board:
-    def __init__(self, master, cell_size=1, font_size=50,
+    def __init__(self, master, game=None, backend="mailbox", cell_size=1, font_size=50,
             font_name="Helvetica", valid_text="·", active_colour="gray80",
             w_square_colour="sandy brown", b_square_colour="saddle brown",
-            check_colour="yellow", checkmate_colour="red"):
+            check_colour="yellow", checkmate_colour="red", computer_players=(), movetime=1.0,
+            book=None, tablebases=None, profile=None, poll_ms=16):
         self.master = master
-        self.size = 8
+        if game == None: game = Game(backend)
+        self.game = game
+        self.size = game.size
         self.cell_size = cell_size
         self.font_size = font_size
         self.font_name = font_name
@@ -34,14 +53,41 @@ class Board:
         self.b_square_colour = b_square_colour
 
         self.active_piece = None
-        self.active_player = "w"
-        self.kings = {"w": None, "b": None}
-
-        self.move_history = []
-        self.move_future = []
+        self.valid_locations = set()
+
+        # Locations of the cells changed since the last flush, and whether a flush is waiting
+        self.dirty = set()
+        self.flush_pending = False
+
+        # The engine plays for the players in computer_players, spending movetime seconds
+        # a move, after any moves from the opening book (a book.PolyglotBook). Once the
+        # position is in the tablebases (a tablebase.Tablebases), its result is shown.
+        self.book = book
+        self.tablebases = tablebases
+        self.engine = engine.Engine(book=book, tablebases=tablebases)
+        self.computer_players = computer_players
+        self.movetime = movetime
+
+        # The thread running the current search, if any, and the queue it puts its
+        # (search id, result) on. Each search gets a new id; cancelling one moves the id
+        # on, so a late result from it is thrown away. Results are polled for every
+        # poll_ms milliseconds (16 is about 60 frames a second).
+        self.search_thread = None
+        self.search_id = 0
+        self.search_results = queue.Queue()
+        self.poll_ms = poll_ms
+
+        # The pawn and destination cell of a promotion waiting for the player to pick a
+        # piece, and the picker's widgets
+        self.pending_promotion = None
+        self.promotion_widgets = []
+
+        # With a file in profile, the hot function counters (see profiling.py) are
+        # written to it after each move
+        self.profile = profile
 
         self.init_cells()
-        self.init_pieces()
+        self.game.subscribe(self.game_event)
 
     def init_cells(self):
         self.cells = []
@@ -60,206 +106,275 @@ class Board:
         else:
             bg = self.w_square_colour
 
-        cell.widget = tk.Label(self.master, text=str(cell),
+        cell.widget = tk.Label(self.master, text=str(self.game.cells[r][c]),
             width=self.cell_size*2, height=self.cell_size,
             font=(self.font_name, self.font_size),
             background=bg)
         cell.widget.grid(row=r, column=c)
         cell.widget.bind("<Button-1>", lambda e: self.click_handler(cell))
+        cell.text = cell.widget["text"]
         cell.orig_colour = bg
         cell.prev_colour = bg
 
-    def init_pieces(self):
-        for r in range(self.size):
-            for c in range(self.size):
-                cell = self.cells[r][c]
-
-                if r < 2: colour = "b"
-                else: colour = "w"
+    def game_event(self, event, *args):
+        if event == "cell":
+            self.dirty.add((args[0].location[0], args[0].location[1]))
+        elif event == "position":
+            self.dirty.update((r, c) for r in range(self.size) for c in range(self.size))
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.master.after_idle(self.flush)
+
+    # Redraw the cells which changed since the last flush, then the check and checkmate highlights
+    def flush(self):
+        self.flush_pending = False
+        for r, c in self.dirty:
+            cell = self.cells[r][c]
+            cell.set_colour(cell.orig_colour)
+            cell.update_entry(str(self.game.cells[r][c]))
+        self.dirty.clear()
+        self.paint_check()
+
+    # Show a position given in FEN (see Game.load_fen) in place of the current one.
+    # A bad FEN raises ValueError and leaves the position as it was, but its pieces
+    # are made anew either way, so the selection is dropped and the board redrawn.
+    def load_fen(self, fen):
+        self.cancel_engine()
+        self.close_promotion_picker()
+        try:
+            self.game.load_fen(fen)
+        finally:
+            self.active_piece = None
+            self.valid_locations = set()
+            self.dirty.update((r, c) for r in range(self.size) for c in range(self.size))
+            self.schedule_flush()
+
+    def view_cell(self, piece):
+        return self.cells[piece.location[0]][piece.location[1]]
+
+    # When a pawn reaches the other side of the board, show the pieces it can become in a
+    # row under the board; the move is made once one is clicked (see choose_promotion)
+    def open_promotion_picker(self, pawn, cell):
+        self.pending_promotion = (pawn, cell)
+        for i, piece_id in enumerate(("4", "3", "1", "2")):
+            piece_type = promotion_pieces[self.game.promotion_kinds[piece_id]]
+            widget = tk.Label(self.master, text=piece_type.name[pawn.colour],
+                width=self.cell_size*2, height=self.cell_size,
+                font=(self.font_name, self.font_size),
+                background=self.active_colour)
+            widget.grid(row=self.size, column=self.size//2 - 2 + i)
+            widget.bind("<Button-1>", lambda e, piece_id=piece_id: self.choose_promotion(piece_id))
+            self.promotion_widgets.append(widget)
+
+    def close_promotion_picker(self):
+        if self.pending_promotion != None:
+            active_cell = self.view_cell(self.pending_promotion[0])
+            active_cell.widget["bg"] = active_cell.prev_colour
+        for widget in self.promotion_widgets: widget.destroy()
+        self.promotion_widgets = []
+        self.pending_promotion = None
+
+    def choose_promotion(self, piece_id):
+        if self.pending_promotion == None: return
+        pawn, cell = self.pending_promotion
+        self.close_promotion_picker()
+        self.active_piece = pawn
+        self.move_handler(cell, piece_id)
 
-                if r == 0 or r == self.size-1:
-                    if c == 0 or c == self.size-1: cell.piece = Rook(self, cell, colour, [r,c])
-                    elif c == 1 or c == self.size-2: cell.piece = Knight(self, cell, colour, [r,c])
-                    elif c == 2 or c == self.size-3: cell.piece = Bishop(self, cell, colour, [r,c])
-                    elif c == 4:
-                        cell.piece = King(self, cell, colour, [r,c])
-                        self.kings[colour] = cell.piece
-                    elif c == 3: cell.piece = Queen(self, cell, colour, [r,c])
-                elif r == 1 or r == self.size-2:
-                    cell.piece = Pawn(self, cell, colour, [r,c])
+    def click_handler(self, cell):
+        piece = self.game.cells[cell.location[0]][cell.location[1]].piece
 
-                cell.widget["text"] = str(cell)
+        # A click on the board instead of the promotion picker takes back the promotion
+        if self.pending_promotion != None:
+            self.close_promotion_picker()
+            return
 
-    def click_handler(self, cell):
         # There is no active piece and the clicked cell contains no piece
         # Nothing needs to be done; return
-        if self.active_piece == None and (cell.piece == None
-                or cell.piece.colour != self.active_player):
+        if self.active_piece == None and (piece == None
+                or piece.colour != self.game.active_player):
             return
 
         # Otherwise, if there is no active piece, set it to the one we clicked on.
         # Also show possible moves, and change colour of current cell.
         if self.active_piece == None:
-            self.active_piece = cell.piece
+            self.active_piece = piece
             if cell.orig_colour == None: cell.orig_colour = cell.widget["bg"]
             cell.prev_colour = cell.widget["bg"]
             cell.widget["bg"] = self.active_colour
 
-            moves = cell.piece.get_moves()
-            self.valid_locations = []
-            for move in moves:
-                self.valid_locations.append([move[0] + cell.location[0], move[1] + cell.location[1]])
-
+            self.valid_locations = self.game.legal_destinations(piece)
             self.paint_valid_locations(self.valid_text)
 
         # If there is an active piece, but we do not click a valid location,
         # do nothing but clear up the UI, and forget the active piece.
-        elif cell.location not in self.valid_locations:
-            self.active_piece.cell.widget["bg"] = self.active_piece.cell.prev_colour
+        elif cell.location[0]*self.size + cell.location[1] not in self.valid_locations:
+            active_cell = self.view_cell(self.active_piece)
+            active_cell.widget["bg"] = active_cell.prev_colour
             self.active_piece = None
             self.paint_valid_locations(orig=True)
 
         # Otherwise, there must be an active piece and we must have clicked a valid location.
-        # Move the piece and clear up the UI.
+        # Move the piece (once a promotion is picked, for a pawn reaching the far side) and
+        # clear up the UI.
         else:
-            self.move_handler(cell)
             self.paint_valid_locations(orig=True)
+            game_cell = self.game.cells[cell.location[0]][cell.location[1]]
+            if self.game.is_promotion(self.active_piece, game_cell.location):
+                self.open_promotion_picker(self.active_piece, cell)
+                self.active_piece = None
+            else:
+                self.move_handler(cell)
 
     # This function can insert chosen text in valid locations to make them visible to the user.
     # This needs to be undone afterwards in another call, and is done by setting orig=True.
     def paint_valid_locations(self, text=None, orig=False):
-        for cell in self.valid_locations:
-            r, c = cell[0], cell[1]
+        for sq in self.valid_locations:
+            r, c = divmod(sq, self.size)
             if orig: text = ""
-            if self.cells[r][c].piece == None: self.cells[r][c].widget["text"] = text
+            if self.game.cells[r][c].piece == None: self.cells[r][c].update_entry(text)
 
-    def move_handler(self, cell):
-        # TODO: when castling implemented --> you can't castle out of check
-
-        old_cell = self.active_piece.cell
-        taken_piece = cell.piece
-        move_made = [cell.location[0] - self.active_piece.location[0], cell.location[1] - self.active_piece.location[1]]
+    def move_handler(self, cell, promotion=None):
+        # The player's move replaces any the engine is thinking about
+        self.cancel_engine()
+        active_cell = self.view_cell(self.active_piece)
+        moved = self.game.move_handler(self.active_piece, self.game.cells[cell.location[0]][cell.location[1]], promotion)
+        self.active_piece = None
 
-        if not self.test_move_for_check(cell):
-            self.active_piece.move(cell)
-            self.paint_valid_locations(orig=True)
-        else:
+        if not moved:
             print("You can't make a move that puts your king in check!")
-            self.active_piece = None
+            active_cell.widget["bg"] = active_cell.prev_colour
             return
 
-        self.move_history.append([[self.active_piece, old_cell]])
-
-        # Check for en passent, put taken pawn in history and update its square
-        if taken_piece == None and self.active_piece.name["w"]=="♙" and move_made in self.active_piece.takes:
-            taken_piece = self.cells[cell.location[0] - self.active_piece.orig_movements[0][0]][cell.location[1]].piece
-            self.move_history[-1].append([taken_piece, taken_piece.cell])
-            taken_piece.cell.piece = None
-            taken_piece.cell.update_entry()
-            taken_piece = None
-
-        # If this piece is a king and we are moving two squares,
-        # move the rook as well, and add both to move history
-        if self.active_piece == self.kings[self.active_player]:
-            if cell.location[1] - old_cell.location[1] > 1:
-                self.move_rook(2, self.cells[cell.location[0]][cell.location[1]-1])
-            elif cell.location[1] - old_cell.location[1] < -1:
-                self.move_rook(1, self.cells[cell.location[0]][cell.location[1]+1])
-
-        if taken_piece != None: self.move_history[-1].append([taken_piece, cell])
-        self.move_future = []
-        self.active_piece = None
-
-        # If the move went ahead, switch players
-        self.switch_players()
-
-        # If the new player is in check, then test if they are in checkmate
-        if self.in_check(self.active_player, draw=True) and self.checkmate(self.active_player):
-            if self.active_player == "w": win_msg = "Black "
-            else: win_msg = "White "
-            win_msg += "wins by checkmate!"
+        self.paint_valid_locations(orig=True)
+        self.move_made()
+
+    # Show the result of the game if it's over, otherwise any tablebase result, and
+    # let the engine move if it plays for the next player. Profile counters are
+    # written first, so each line covers one move.
+    def move_made(self):
+        if self.profile != None and self.game.move_history != []:
+            move = self.game.move_history[-1][0]
+            profiling.dump(self.profile, move=self.game.move_name(move), ply=self.game.ply())
+        if self.game.active_player == None:
+            if self.game.winner == None: win_msg = "Draw by stalemate!"
+            elif self.game.winner == "w": win_msg = "White wins by checkmate!"
+            else: win_msg = "Black wins by checkmate!"
             print(win_msg)
-            self.active_player = None
-
-    def move_rook(self, which, cell):
-        for r in self.cells:
-            for c in r:
-                if c.piece != None and c.piece.name["w"] == "♖" and c.piece.colour == self.active_player:
-                    which -= 1
-                    if which == 0:
-                        self.move_history[-1].append([c.piece, c])
-                        c.piece.move(cell)
-
-    def in_check(self, player, draw=False):
-        check = self.kings[player].is_threatened()[0]
-        if draw:
-            if check:
-                self.kings[player].cell.widget["bg"] = self.check_colour
-            else:
-                self.kings[player].cell.widget["bg"] = self.kings[player].cell.orig_colour
-        return check
-
-    def test_move_for_check(self, cell, draw=False):
-        check = False
-        old_cell = self.active_piece.cell
-        self.active_piece.move(cell)
-        if self.in_check(self.active_piece.colour, draw):
-            self.active_piece.move(old_cell)
-            if draw: self.active_piece.cell.widget["bg"] = self.active_piece.cell.prev_colour
-            check = True
-        self.active_piece.move(old_cell)
-        return check
-
-    def checkmate(self, player):
-        checkmated = True
-        for row in self.cells:
-            for cell in row:
-                piece = cell.piece
-                if piece == None or piece.colour != player: continue
-                moves = piece.get_moves()
-                for move in moves:
-                    # Convert move to new location
-                    move[0] += cell.location[0]
-                    move[1] += cell.location[1]
-
-                    # Keep track of piece at destination
-                    dest_piece = self.cells[move[0]][move[1]].piece
-
-                    # Move piece there, test for check, and move back
-                    piece.move(self.cells[move[0]][move[1]], draw=False)
-                    if not self.in_check(player): checkmated = False
-                    piece.move(cell, draw=False)
-
-                    # Reset piece at destination, and return false if move removed check
-                    self.cells[move[0]][move[1]].piece = dest_piece
-                    if not checkmated:
-                        return False
-
-        self.kings[player].cell.widget["bg"] = self.checkmate_colour
-        return True
+            return
+        self.report_tablebase()
+        if self.game.active_player in self.computer_players:
+            self.master.after(1, self.engine_move)
+
+    # Let the engine make a move for the player to move. It searches a copy of the game in
+    # a background thread, and poll_engine plays its move when it is found.
+    def engine_move(self):
+        if self.game.active_player == None or self.search_thread != None: return
+        self.search_id += 1
+        game = self.game.copy(history=True)
+        self.search_thread = self.engine.start_thread(self.search_worker, self.search_id, game)
+        self.master.after(self.poll_ms, self.poll_engine)
+
+    def search_worker(self, search_id, game):
+        self.search_results.put((search_id, self.engine.search(game, movetime=self.movetime, info=engine.print_info)))
+
+    def poll_engine(self):
+        try:
+            search_id, result = self.search_results.get_nowait()
+        except queue.Empty:
+            if self.search_thread != None: self.master.after(self.poll_ms, self.poll_engine)
+            return
+        self.search_thread = None
+        if search_id == self.search_id: self.play_engine_move(result)
 
-    def unredo_move(self, mode):
-        if mode == "undo":
-            pop_from, push_to = self.move_history, self.move_future
-        elif mode == "redo":
-            pop_from, push_to = self.move_future, self.move_history
+    # Stop the engine's search, if it is thinking, and forget its result
+    def cancel_engine(self):
+        if self.search_thread == None: return
+        self.search_id += 1
+        self.engine.stop_thread(self.search_thread)
+        self.search_thread = None
+        while not self.search_results.empty(): self.search_results.get_nowait()
 
-        if self.active_player == None or pop_from == []:
-            return
+    def play_engine_move(self, result):
+        if result["move"] == None or self.game.active_player == None: return
+        self.close_promotion_picker()
 
-        moves = pop_from.pop()
-        push_to.append([])
-        castling = len(moves)>1 and moves[0][0].colour == moves[1][0].colour
-        for i, move in enumerate(moves):
-            push_to[-1].append([move[0], move[0].cell])
-            if mode != "redo" or i == 0 or castling: move[0].move(move[1], unredo=True)
+        self.forget_active_piece()
 
-        self.in_check(self.active_player, draw=True)
-        self.switch_players()
-        self.in_check(self.active_player, draw=True)
+        if result["book"]:
+            print("Engine plays {} (book)".format(result["name"]))
+        else:
+            print("Engine plays {} (depth {}, {} nodes, {} nodes/s)".format(result["name"],
+                result["depth"], result["nodes"], result["nps"]))
+        self.game.play_move(result["move"])
+        self.move_made()
+
+    # Forget any piece the user had picked up
+    def forget_active_piece(self):
+        if self.active_piece != None:
+            active_cell = self.view_cell(self.active_piece)
+            active_cell.widget["bg"] = active_cell.prev_colour
+            self.paint_valid_locations(orig=True)
+            self.active_piece = None
 
-    def switch_players(self):
-        if self.active_player == "w":
-            self.active_player = "b"
+    # Print the tablebase result of the position, if it has one
+    def report_tablebase(self):
+        if self.tablebases == None or self.game.piece_count > tablebase.max_pieces: return
+        found = self.tablebases.probe(self.game)
+        if found == None: return
+        result, plies = found
+        player = {"w": "White", "b": "Black"}
+        if result == "draw":
+            print("Tablebase: draw")
         else:
-            self.active_player = "w"
+            winner = self.game.active_player if result == "win" else self.game.opponent(self.game.active_player)
+            print("Tablebase: {} mates in {}".format(player[winner], (plies + 1) // 2))
+
+    # Print the opening book's moves for the position, as a hint
+    def book_hint(self):
+        if self.book == None or self.game.active_player == None: return
+        moves = self.book.moves(self.game)
+        if moves == []:
+            print("No book moves")
+            return
+        total = sum(weight for move, weight in moves)
+        print("Book moves: " + ", ".join("{} ({:.0f}%)".format(self.game.move_name(move), 100.0 * weight / total if total else 0)
+            for move, weight in moves))
+
+    # Highlight the king of a player who is checkmated or in check, and restore the other
+    def paint_check(self):
+        for player in self.game.kings:
+            cell = self.view_cell(self.game.kings[player])
+            if self.game.winner != None and player != self.game.winner:
+                cell.set_colour(self.checkmate_colour)
+            elif self.game.in_check(player):
+                cell.set_colour(self.check_colour)
+            else:
+                cell.set_colour(cell.orig_colour)
+
+    # The cells which change are redrawn by flush. Undoing or redoing stops the engine.
+    def unredo_move(self, mode):
+        self.cancel_engine()
+        self.close_promotion_picker()
+        self.forget_active_piece()
+        self.game.unredo_move(mode)
+
+    # Jump to a ply of the current line (see Game.goto_ply); None is its last ply.
+    # The board is redrawn once, whatever the distance.
+    def goto_ply(self, n=None):
+        self.cancel_engine()
+        self.close_promotion_picker()
+        self.forget_active_piece()
+        if n == None: n = self.game.line_end()
+        self.game.goto_ply(n)
+
+    # Make redo follow the next variation played from this position, and say which it is
+    def switch_variation(self):
+        move = self.game.switch_variation()
+        if move == None: return
+        variations = self.game.variations()
+        print("Redo plays {} ({} variations: {})".format(self.game.move_name(move), len(variations),
+            ", ".join(self.game.move_name(variation) for variation in variations)))
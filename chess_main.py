@@ -1,18 +1,86 @@
 from board_logic import Board
 import setup_tools
+import pgn
+import book
+import tablebase
+import profiling
+import uci
 
 import tkinter as tk
 import argparse
+import sys
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--setup", type=str, default="play", help="choose starting positions")
+parser.add_argument("--setup", type=str, default=None,
+                    help="starting position: a name from setup_tools, a FEN string, or a file with one FEN per line")
+parser.add_argument("--backend", type=str, default="mailbox", choices=["mailbox", "bitboard"],
+                    help="move generation backend")
+parser.add_argument("--computer", type=str, default="none", choices=["none", "w", "b", "both"],
+                    help="players the engine plays for (press e for an engine move at any time)")
+parser.add_argument("--movetime", type=float, default=1.0, help="seconds the engine spends on a move")
+parser.add_argument("--book", type=str, default=None,
+                    help="Polyglot opening book for the engine (press h for the book moves)")
+parser.add_argument("--book-keys", type=str, default=None, help="file of the 781 Polyglot keys for --book")
+parser.add_argument("--tablebases", type=str, default=None,
+                    help="directory of endgame tablebases (see tablebase.py) for the engine and results")
+parser.add_argument("--profile", type=str, default=None,
+                    help="write call counts and times of the hot functions after each move, as JSON lines, to this file (- for stderr)")
+parser.add_argument("--uci", action="store_true",
+                    help="run the engine over the Universal Chess Interface on stdin/stdout instead of opening the window")
 
 args = parser.parse_args()
 
+if args.uci:
+    uci.UciEngine(book_path=args.book, book_keys_path=args.book_keys, tablebase_dir=args.tablebases, backend=args.backend).run()
+    sys.exit()
+
 root = tk.Tk()
-board = Board(root)
+computer_players = {"none": (), "w": ("w",), "b": ("b",), "both": ("w", "b")}[args.computer]
+opening_book = None
+if args.book != None:
+    opening_book = book.PolyglotBook(args.book, book.load_keys(args.book_keys) if args.book_keys else book.default_keys)
+tables = tablebase.Tablebases(args.tablebases) if args.tablebases != None else None
+profile = None
+if args.profile != None:
+    profiling.install()
+    profile = sys.stderr if args.profile == "-" else open(args.profile, "a")
+board = Board(root, backend=args.backend, computer_players=computer_players, movetime=args.movetime,
+    book=opening_book, tablebases=tables, profile=profile)
 root.bind("z", lambda e: board.unredo_move(mode="undo"))
 root.bind("y", lambda e: board.unredo_move(mode="redo"))
-if args.setup != "play":
-    setup_tools.setup_locations(board, setup_tools.setups[args.setup])
+root.bind("<Home>", lambda e: board.goto_ply(0))
+root.bind("<End>", lambda e: board.goto_ply())
+root.bind("v", lambda e: board.switch_variation())
+root.bind("e", lambda e: board.engine_move())
+root.bind("f", lambda e: print(board.game.fen()))
+root.bind("g", lambda e: print(pgn.game_pgn(board.game)))
+root.bind("h", lambda e: board.book_hint())
+
+# With a file of several positions, n and p step through them
+positions = []
+if args.setup != None:
+    positions = setup_tools.setup_positions(args.setup)
+    if positions == []:
+        parser.error("no positions in {}".format(args.setup))
+    try:
+        board.load_fen(positions[0])
+    except ValueError as e:
+        parser.error(str(e))
+position_index = 0
+
+def step_position(step):
+    global position_index
+    if positions == []: return
+    position_index = (position_index + step) % len(positions)
+    print("Position {} of {}: {}".format(position_index + 1, len(positions), positions[position_index]))
+    try:
+        board.load_fen(positions[position_index])
+    except ValueError as e:
+        print(e)
+
+root.bind("n", lambda e: step_position(1))
+root.bind("p", lambda e: step_position(-1))
+
+if board.game.active_player in computer_players:
+    root.after(1, board.engine_move)
 root.mainloop()
@@ -0,0 +1,437 @@
+from game_logic import Game, move_name, start_fen
+from bitboard_logic import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, EN_PASSANT, KNIGHT_ATTACKS, BISHOP_RAYS, ROOK_RAYS
+from bitboard_logic import squares as bit_squares
+from zobrist import TranspositionTable, EXACT, LOWER, UPPER
+import book
+import tablebase
+
+import argparse
+import random
+import threading
+import time
+
+# A computer player: negamax alpha-beta search with iterative deepening, quiescence
+# search, a transposition table, and move ordering by table move, MVV-LVA captures,
+# killer moves and the history heuristic. It searches a Game in place with
+# make_move/unmake_move, so it can run headless or behind the tkinter Board.
+
+MATE = 100000
+INFINITY = 1000000
+# Scores beyond this are mates, stored in the table relative to the node rather than the root
+MATE_BOUND = MATE - 1000
+
+piece_values = [100, 320, 330, 500, 900, 0]
+
+# Piece-square tables (from the "Simplified Evaluation Function"), indexed by square
+# r*8 + c with row 0 the far side, as seen by white. Black uses them mirrored (sq ^ 56).
+piece_square_tables = [
+    [0,  0,  0,  0,  0,  0,  0,  0,
+     50, 50, 50, 50, 50, 50, 50, 50,
+     10, 10, 20, 30, 30, 20, 10, 10,
+     5,  5, 10, 25, 25, 10,  5,  5,
+     0,  0,  0, 20, 20,  0,  0,  0,
+     5, -5,-10,  0,  0,-10, -5,  5,
+     5, 10, 10,-20,-20, 10, 10,  5,
+     0,  0,  0,  0,  0,  0,  0,  0],
+    [-50,-40,-30,-30,-30,-30,-40,-50,
+     -40,-20,  0,  0,  0,  0,-20,-40,
+     -30,  0, 10, 15, 15, 10,  0,-30,
+     -30,  5, 15, 20, 20, 15,  5,-30,
+     -30,  0, 15, 20, 20, 15,  0,-30,
+     -30,  5, 10, 15, 15, 10,  5,-30,
+     -40,-20,  0,  5,  5,  0,-20,-40,
+     -50,-40,-30,-30,-30,-30,-40,-50],
+    [-20,-10,-10,-10,-10,-10,-10,-20,
+     -10,  0,  0,  0,  0,  0,  0,-10,
+     -10,  0,  5, 10, 10,  5,  0,-10,
+     -10,  5,  5, 10, 10,  5,  5,-10,
+     -10,  0, 10, 10, 10, 10,  0,-10,
+     -10, 10, 10, 10, 10, 10, 10,-10,
+     -10,  5,  0,  0,  0,  0,  5,-10,
+     -20,-10,-10,-10,-10,-10,-10,-20],
+    [0,  0,  0,  0,  0,  0,  0,  0,
+     5, 10, 10, 10, 10, 10, 10,  5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     0,  0,  0,  5,  5,  0,  0,  0],
+    [-20,-10,-10, -5, -5,-10,-10,-20,
+     -10,  0,  0,  0,  0,  0,  0,-10,
+     -10,  0,  5,  5,  5,  5,  0,-10,
+     -5,  0,  5,  5,  5,  5,  0, -5,
+     0,  0,  5,  5,  5,  5,  0, -5,
+     -10,  5,  5,  5,  5,  5,  0,-10,
+     -10,  0,  5,  0,  0,  0,  0,-10,
+     -20,-10,-10, -5, -5,-10,-10,-20],
+    [-30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -20,-30,-30,-40,-40,-30,-30,-20,
+     -10,-20,-20,-20,-20,-20,-20,-10,
+     20, 20,  0,  0,  0,  0, 20, 20,
+     20, 30, 10,  0,  0, 10, 30, 20],
+]
+
+# The material and piece-square score of each piece code (see piece_logic) on each
+# square, from white's point of view
+code_square_scores = [[0]*64 for code in range(16)]
+for kind in range(6):
+    for sq in range(64):
+        code_square_scores[kind + 1][sq] = piece_values[kind] + piece_square_tables[kind][sq]
+        code_square_scores[kind + 9][sq] = -(piece_values[kind] + piece_square_tables[kind][sq ^ 56])
+
+# Mobility is approximated by the empty squares each knight, bishop, rook and queen
+# could reach on an empty board (ignoring pieces in the way), worth these many
+# centipawns each
+mobility_weights = [0, 4, 3, 2, 1, 0]
+reach_tables = [None, KNIGHT_ATTACKS,
+    [BISHOP_RAYS[0][0][sq] | BISHOP_RAYS[0][1][sq] | BISHOP_RAYS[1][0][sq] | BISHOP_RAYS[1][1][sq] for sq in range(64)],
+    [ROOK_RAYS[0][0][sq] | ROOK_RAYS[0][1][sq] | ROOK_RAYS[1][0][sq] | ROOK_RAYS[1][1][sq] for sq in range(64)],
+    None, None]
+reach_tables[QUEEN] = [reach_tables[BISHOP][sq] | reach_tables[ROOK][sq] for sq in range(64)]
+
+# King safety: a bonus for each of the king's own pawns in the two rows in front of it
+# (on its own and the neighbouring files), and a penalty for each enemy knight, bishop,
+# rook or queen within two squares of it
+shield_weight = 10
+attacker_weight = 10
+def _king_table(rows):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        bb = 0
+        for dr in rows:
+            for dc in (-1, 0, 1):
+                if 0 <= r+dr < 8 and 0 <= c+dc < 8: bb |= 1 << ((r+dr)*8 + c+dc)
+        table.append(bb)
+    return table
+shield_tables = {"w": _king_table((-1, -2)), "b": _king_table((1, 2))}
+king_zones = [sum(1 << (r*8 + c) for r in range(8) for c in range(8) if max(abs(r - sq // 8), abs(c - sq % 8)) <= 2)
+    for sq in range(64)]
+
+# The score of the position, from the point of view of the player to move
+def evaluate(game):
+    return evaluate_squares(game.squares, game.active_player)
+
+# The score of a board of piece codes (e.g. Game.squares or Position.board): material,
+# piece-square tables, mobility and king safety. batch_eval.evaluate_batch gives the
+# same scores for many boards at once.
+def evaluate_squares(squares, active_player):
+    score = 0
+    occupied = 0
+    bits = [0] * 16
+    for sq, code in enumerate(squares):
+        if code:
+            score += code_square_scores[code][sq]
+            occupied |= 1 << sq
+            bits[code] |= 1 << sq
+    empty = ~occupied
+
+    for kind in (KNIGHT, BISHOP, ROOK, QUEEN):
+        reach, weight = reach_tables[kind], mobility_weights[kind]
+        for sq in bit_squares(bits[kind + 1]): score += weight * (reach[sq] & empty).bit_count()
+        for sq in bit_squares(bits[kind + 9]): score -= weight * (reach[sq] & empty).bit_count()
+
+    white_pieces = bits[2] | bits[3] | bits[4] | bits[5]
+    black_pieces = bits[10] | bits[11] | bits[12] | bits[13]
+    for sq in bit_squares(bits[KING + 1]):
+        score += shield_weight * (shield_tables["w"][sq] & bits[PAWN + 1]).bit_count()
+        score -= attacker_weight * (king_zones[sq] & black_pieces).bit_count()
+    for sq in bit_squares(bits[KING + 9]):
+        score -= shield_weight * (shield_tables["b"][sq] & bits[PAWN + 9]).bit_count()
+        score += attacker_weight * (king_zones[sq] & white_pieces).bit_count()
+
+    if active_player == "b": return -score
+    return score
+
+# Seconds to spend on a move, given the clock time left, the increment per move and,
+# if known, the number of moves until the next time control
+def allocate_time(time_left, increment=0, moves_to_go=None):
+    if moves_to_go == None or moves_to_go <= 0: moves_to_go = 30
+    budget = time_left / moves_to_go + increment * 0.8
+    return max(0.01, min(budget, time_left * 0.5))
+
+class Engine:
+    # book, if given, is a book.PolyglotBook whose moves are played without searching,
+    # chosen as in PolyglotBook.choose with book_mode. tablebases, if given, is a
+    # tablebase.Tablebases giving exact scores once few enough pieces are left.
+    def __init__(self, hash_mb=16, book=None, book_mode="weighted", tablebases=None):
+        self.table = TranspositionTable(hash_mb)
+        self.stopped = False
+        # Requests for the search start_thread is about to run, which search takes when
+        # it begins, so a stop or movetime sent before the thread gets that far isn't lost
+        self.pending = None
+        self.book = book
+        self.book_mode = book_mode
+        self.tablebases = tablebases
+        self.random = random.Random()
+
+    # Ask a running search to stop as soon as possible (e.g. from another thread);
+    # it returns the best move of the last finished iteration.
+    def stop(self):
+        pending = self.pending
+        if pending != None: pending["stop"] = True
+        self.stopped = True
+
+    # Call target with args (e.g. a function which searches and hands on the result)
+    # in a background thread, and return the thread
+    def start_thread(self, target, *args):
+        self.pending = {"stop": False, "deadline": None}
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    # Stop the search in a thread from start_thread and wait for the thread to finish.
+    # The search checks for the stop every few hundred nodes, so this only takes a moment.
+    def stop_thread(self, thread):
+        self.stop()
+        thread.join()
+        self.pending = None
+
+    # Give a running search a time limit of movetime seconds from now, e.g. when a
+    # search started without one (while pondering) becomes a real one
+    def set_movetime(self, movetime):
+        deadline = time.perf_counter() + movetime
+        pending = self.pending
+        if pending != None: pending["deadline"] = deadline
+        self.deadline = deadline
+
+    # Search the game's position for the player to move. Stops at depth, after movetime
+    # seconds or after nodes nodes, whichever comes first. info, if given, is called
+    # with a dict after each finished iteration. Returns a dict with the best move
+    # (encoded, and its name), score (centipawns for the player to move), depth
+    # reached, nodes searched, time, nodes/sec and principal variation. "book" is
+    # True if the move came from the opening book.
+    def search(self, game, depth=64, movetime=None, nodes=None, info=None):
+        self.game = game
+        self.stopped = False
+        self.nodes = 0
+        self.node_limit = nodes
+        self.start_time = time.perf_counter()
+        self.deadline = None
+        if movetime != None: self.deadline = self.start_time + movetime
+        # Set after the resets above, so a request made while they run still counts
+        pending, self.pending = self.pending, None
+        if pending != None and pending["stop"]: self.stopped = True
+        if pending != None and pending["deadline"] != None: self.deadline = pending["deadline"]
+        self.killers = [[0, 0] for ply in range(128)]
+        self.history = {"w": [0] * 4096, "b": [0] * 4096}
+        self.table.new_search()
+
+        result = {"move": None, "name": None, "score": 0, "depth": 0, "nodes": 0,
+            "time": 0.0, "nps": 0, "pv": [], "book": False}
+        if self.book != None:
+            move = self.book.choose(game, self.book_mode, self.random)
+            if move != None:
+                result.update(move=move, name=move_name(move), pv=[move_name(move)], book=True)
+                return result
+
+        root_moves = game.legal_moves()
+        if root_moves == []:
+            return result
+        best_move = root_moves[0]
+
+        for d in range(1, depth+1):
+            self.root_best = None
+            score = self.negamax(d, -INFINITY, INFINITY, 0)
+            if self.stopped:
+                # A partly searched iteration can still have found a better move
+                # than the last one, as the last best move is searched first
+                if self.root_best != None: best_move = self.root_best
+                break
+            best_move = self.root_best
+            result["depth"], result["score"] = d, score
+            self.fill_result(result, best_move)
+            if info != None: info(dict(result))
+            # No point searching deeper once a forced mate has been found
+            if abs(score) > MATE_BOUND: break
+
+        self.fill_result(result, best_move)
+        return result
+
+    def fill_result(self, result, best_move):
+        elapsed = time.perf_counter() - self.start_time
+        result["move"], result["name"] = best_move, move_name(best_move)
+        result["nodes"], result["time"] = self.nodes, round(elapsed, 6)
+        result["nps"] = int(self.nodes / elapsed) if elapsed > 0 else 0
+        result["pv"] = [move_name(move) for move in self.principal_variation(best_move, max(result["depth"], 1))]
+
+    # Follow the best moves stored in the table from the root
+    def principal_variation(self, best_move, depth):
+        game = self.game
+        pv = []
+        move = best_move
+        while move and len(pv) < depth and move in game.legal_moves():
+            pv.append(move)
+            game.make_move(move)
+            entry = self.table.probe(game.hash)
+            move = entry[3] if entry != None else 0
+        for i in range(len(pv)): game.unmake_move()
+        return pv
+
+    def check_limits(self):
+        if self.node_limit != None and self.nodes >= self.node_limit: self.stopped = True
+        if self.deadline != None and time.perf_counter() >= self.deadline: self.stopped = True
+
+    def negamax(self, depth, alpha, beta, ply):
+        game = self.game
+        self.nodes += 1
+        if self.nodes & 255 == 0: self.check_limits()
+        if self.stopped: return 0
+
+        # Draws by the fifty move rule or repetition
+        if ply > 0 and (game.halfmove_clock >= 100 or game.repetitions() > 1): return 0
+
+        # Positions in the tablebases have exact scores, so needn't be searched
+        if ply > 0 and self.tablebases != None and game.piece_count <= tablebase.max_pieces:
+            found = self.tablebases.probe(game)
+            if found != None:
+                result, plies = found
+                if result == "win": return MATE - ply - plies
+                if result == "loss": return -MATE + ply + plies
+                return 0
+
+        in_check = game.in_check(game.active_player)
+        # Look one move deeper when in check, so that checks near the horizon are resolved
+        if in_check: depth += 1
+        if depth <= 0: return self.quiesce(alpha, beta, ply)
+
+        original_alpha = alpha
+        table_move = 0
+        entry = self.table.probe(game.hash)
+        if entry != None:
+            table_depth, table_score, bound, table_move = entry
+            if table_depth >= depth and ply > 0:
+                table_score = self.score_from_table(table_score, ply)
+                if (bound == EXACT or (bound == LOWER and table_score >= beta)
+                        or (bound == UPPER and table_score <= alpha)):
+                    return table_score
+
+        moves = game.legal_moves()
+        if moves == []:
+            if in_check: return -MATE + ply
+            return 0
+
+        best_score, best_move = -INFINITY, 0
+        for move in self.order_moves(moves, table_move, ply):
+            game.make_move(move)
+            score = -self.negamax(depth-1, -beta, -alpha, ply+1)
+            game.unmake_move()
+            if self.stopped: return 0
+
+            if score > best_score:
+                best_score, best_move = score, move
+                if ply == 0: self.root_best = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if not self.is_capture(move):
+                            killers = self.killers[ply]
+                            if killers[0] != move: killers[0], killers[1] = move, killers[0]
+                            self.history[game.active_player][move & 4095] += depth * depth
+                        break
+
+        if best_score <= original_alpha: bound = UPPER
+        elif best_score >= beta: bound = LOWER
+        else: bound = EXACT
+        self.table.store(game.hash, depth, self.score_to_table(best_score, ply), bound, best_move)
+        return best_score
+
+    # Only search captures and promotions past the horizon, so that the evaluation
+    # isn't taken in the middle of an exchange. The player to move can "stand pat"
+    # on the evaluation rather than make a losing capture.
+    def quiesce(self, alpha, beta, ply):
+        game = self.game
+        self.nodes += 1
+        if self.nodes & 255 == 0: self.check_limits()
+        if self.stopped: return 0
+
+        moves = game.legal_moves()
+        if moves == []:
+            if game.in_check(game.active_player): return -MATE + ply
+            return 0
+
+        stand_pat = evaluate(game)
+        if stand_pat >= beta: return stand_pat
+        if stand_pat > alpha: alpha = stand_pat
+
+        captures = [move for move in moves if self.is_capture(move) or move >> 12 & 7]
+        for move in self.order_moves(captures, 0, None):
+            game.make_move(move)
+            score = -self.quiesce(-beta, -alpha, ply+1)
+            game.unmake_move()
+            if self.stopped: return 0
+            if score >= beta: return score
+            if score > alpha: alpha = score
+        return alpha
+
+    def is_capture(self, move):
+        return self.game.square_cells[move >> 6 & 63].piece != None or (move >> 15) & EN_PASSANT
+
+    # Table move first, then captures (most valuable victim, then least valuable
+    # attacker), then killer moves, then other moves by their history score
+    def order_moves(self, moves, table_move, ply):
+        cells = self.game.square_cells
+        history = self.history[self.game.active_player]
+        if ply != None: killers = self.killers[ply]
+        else: killers = ()
+
+        def key(move):
+            if move == table_move: return 10000000
+            victim = cells[move >> 6 & 63].piece
+            promotion = move >> 12 & 7
+            if victim != None or move >> 15 & EN_PASSANT or promotion:
+                victim_value = piece_values[victim.kind] if victim != None else 100
+                if promotion: victim_value += piece_values[promotion]
+                attacker = cells[move & 63].piece.kind
+                return 1000000 + victim_value * 10 - attacker
+            if move in killers: return 900000 - killers.index(move)
+            return history[move & 4095]
+
+        return sorted(moves, key=key, reverse=True)
+
+    def score_to_table(self, score, ply):
+        if score > MATE_BOUND: return score + ply
+        if score < -MATE_BOUND: return score - ply
+        return score
+
+    def score_from_table(self, score, ply):
+        if score > MATE_BOUND: return score - ply
+        if score < -MATE_BOUND: return score + ply
+        return score
+
+def print_info(result):
+    print("depth {} score {} nodes {} time {:.3f}s nps {} pv {}".format(result["depth"],
+        result["score"], result["nodes"], result["time"], result["nps"], " ".join(result["pv"])))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search a position and print the best move")
+    parser.add_argument("--fen", type=str, default=start_fen, help="position to search, in FEN")
+    parser.add_argument("--depth", type=int, default=64, help="maximum depth")
+    parser.add_argument("--movetime", type=float, default=None, help="seconds to search")
+    parser.add_argument("--nodes", type=int, default=None, help="maximum nodes to search")
+    parser.add_argument("--hash", type=float, default=16, help="transposition table size in MB")
+    parser.add_argument("--backend", type=str, default="mailbox", choices=["mailbox", "bitboard"],
+                        help="move generation backend")
+    parser.add_argument("--book", type=str, default=None, help="Polyglot opening book to play from first")
+    parser.add_argument("--book-keys", type=str, default=None, help="file of the 781 Polyglot keys for --book")
+    parser.add_argument("--tablebases", type=str, default=None, help="directory of endgame tablebases")
+    args = parser.parse_args()
+
+    game = Game(args.backend)
+    game.load_fen(args.fen)
+    if args.movetime == None and args.nodes == None and args.depth == 64: args.movetime = 5.0
+
+    opening_book = None
+    if args.book != None:
+        opening_book = book.PolyglotBook(args.book, book.load_keys(args.book_keys) if args.book_keys else book.default_keys)
+    tables = tablebase.Tablebases(args.tablebases) if args.tablebases != None else None
+    result = Engine(args.hash, opening_book, tablebases=tables).search(game, args.depth, args.movetime, args.nodes, print_info)
+    if result["book"]:
+        print("bestmove {} (book)".format(result["name"]))
+    else:
+        print("bestmove {} (depth {}, {} nodes, {} nodes/s)".format(result["name"], result["depth"],
+            result["nodes"], result["nps"]))
@@ -0,0 +1,941 @@
+from piece_logic import *
+from bitboard_logic import Bitboards, piece_kinds, KNIGHT, BISHOP, ROOK, QUEEN, DOUBLE_PUSH, EN_PASSANT, CASTLE
+from zobrist import piece_keys, black_to_move_key, castling_keys, ep_file_keys
+
+# Castling rights are kept as bit flags, one per side and wing
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+castling_flags = {"w": {"king": WHITE_KINGSIDE, "queen": WHITE_QUEENSIDE},
+                  "b": {"king": BLACK_KINGSIDE, "queen": BLACK_QUEENSIDE}}
+# The rights lost when a piece moves from, or is taken on, each square (r*8 + c):
+# the rook corners, and the kings' starting squares
+square_castling_flags = [0]*64
+square_castling_flags[63], square_castling_flags[56] = WHITE_KINGSIDE, WHITE_QUEENSIDE
+square_castling_flags[7], square_castling_flags[0] = BLACK_KINGSIDE, BLACK_QUEENSIDE
+square_castling_flags[60] = WHITE_KINGSIDE | WHITE_QUEENSIDE
+square_castling_flags[4] = BLACK_KINGSIDE | BLACK_QUEENSIDE
+
+# Pieces a pawn can promote to, by the promotion kind in an encoded move (see bitboard_logic)
+promotion_pieces = {KNIGHT: Knight, BISHOP: Bishop, ROOK: Rook, QUEEN: Queen}
+
+# Name of a location in algebraic notation, e.g. [6,4] is "e2"
+def location_name(location):
+    return "abcdefgh"[location[1]] + str(8 - location[0])
+
+# Location of a square named in algebraic notation, e.g. "e2" is [6,4]
+def name_location(name):
+    if len(name) != 2 or name[0] not in "abcdefgh" or name[1] not in "12345678":
+        raise ValueError("Bad square name: {}".format(name))
+    return [8 - int(name[1]), "abcdefgh".index(name[0])]
+
+# The standard starting position in FEN
+start_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# Moves are encoded as integers (see bitboard_logic); these unpack them
+def move_from(move):
+    return move & 63
+
+def move_to(move):
+    return move >> 6 & 63
+
+def move_promotion(move):
+    return move >> 12 & 7
+
+def move_flags(move):
+    return move >> 15
+
+# Long algebraic name of an encoded move, e.g. "e2e4" or "a7a8q"
+def move_name(move):
+    name = location_name(divmod(move_from(move), 8)) + location_name(divmod(move_to(move), 8))
+    if move_promotion(move): name += " nbrq"[move_promotion(move)]
+    return name
+
+# Game holds the position and all of the rules, with no dependency on tkinter,
+# so it can be used on its own for simulation. Views (e.g. board_logic.Board)
+# subscribe to it and are told when a cell changes or the game ends.
+class Cell:
+    __slots__ = ("location", "piece")
+
+    def __init__(self, location, piece=None):
+        self.location = location
+        self.piece = piece
+
+    def __str__(self):
+        if self.piece == None: return ""
+        else: return self.piece.name[self.piece.colour]
+
+# A position on its own, without the pieces, cells or history of a Game: the piece
+# code (see piece_logic) on each square as 64 bytes, and the state which can't be
+# seen from the board, with the en passant square as a square number. Made by
+# Game.snapshot and put back by Game.restore; each takes a couple of hundred bytes.
+class Position:
+    __slots__ = ("board", "active_player", "castling_rights", "ep_square", "halfmove_clock",
+        "fullmove_number", "hash")
+
+    def __init__(self, board, active_player, castling_rights, ep_square, halfmove_clock, fullmove_number, hash):
+        self.board = board
+        self.active_player = active_player
+        self.castling_rights = castling_rights
+        self.ep_square = ep_square
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        self.hash = hash
+
+    def __eq__(self, other):
+        return (isinstance(other, Position) and self.hash == other.hash and self.board == other.board
+            and self.active_player == other.active_player and self.castling_rights == other.castling_rights
+            and self.ep_square == other.ep_square)
+
+    def __hash__(self):
+        return self.hash
+
+# A node in the tree of moves played in a Game (see Game.play_move): the move which
+# led to it from its parent, the moves played from it (variations, kept when a move
+# is taken back and another played), and next, the child which redo follows (the
+# last one played). Every snapshot_interval plies a node also keeps a Position, so
+# any ply can be reached by restoring one and replaying at most that many moves.
+class HistoryNode:
+    __slots__ = ("move", "parent", "children", "next", "ply", "position")
+
+    def __init__(self, move, parent, ply, position=None):
+        self.move = move
+        self.parent = parent
+        self.children = []
+        self.next = None
+        self.ply = ply
+        self.position = position
+
+    # The child for a move, added if it hasn't been played here before, which becomes next
+    def child(self, move):
+        for child in self.children:
+            if child.move == move: break
+        else:
+            child = HistoryNode(move, self, self.ply + 1)
+            self.children.append(child)
+        self.next = child
+        return child
+
+    # The nodes from the root to this one
+    def path(self):
+        path = []
+        node = self
+        while node != None:
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        return path
+
+class Game:
+    # Promotion choices, as used by move_handler, and the kind each one promotes to
+    promotion_names = {'1': "bishop", '2': "knight", '3': "rook", '4': "queen"}
+    promotion_kinds = {'1': BISHOP, '2': KNIGHT, '3': ROOK, '4': QUEEN}
+    # Plies between the positions kept in the history tree
+    snapshot_interval = 16
+
+    # backend selects how pieces generate their moves: "mailbox" walks the cells,
+    # "bitboard" uses the lookup tables in bitboard_logic
+    def __init__(self, backend="mailbox"):
+        self.size = 8
+        self.backend = backend
+        if backend == "bitboard": self.bitboards = Bitboards()
+        elif backend == "mailbox": self.bitboards = None
+        else: raise ValueError("Unknown move generation backend: {}".format(backend))
+
+        self.active_player = "w"
+        self.kings = {"w": None, "b": None}
+        self.winner = None
+
+        # move_history holds an undo record for each move made (see make_move) since
+        # the position was loaded or restored. The moves played, including undone ones
+        # and variations, are kept in a tree of HistoryNodes (see new_history).
+        self.move_history = []
+
+        # Position state which can't be seen from the cells. ep_square is the location
+        # a pawn skipped over on the last move, if it moved two squares.
+        self.castling_rights = WHITE_KINGSIDE | WHITE_QUEENSIDE | BLACK_KINGSIDE | BLACK_QUEENSIDE
+        self.ep_square = None
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+
+        # promotion_handler is called with the pawn about to promote when
+        # move_handler is not given a choice; it should return a key of promotion_names
+        self.promotion_handler = None
+
+        self.listeners = []
+
+        self.init_cells()
+        self.init_pieces()
+        self.init_attacks()
+        if self.bitboards != None: self.bitboards.load(self)
+        # Zobrist key of the position (see zobrist.py), kept up to date by set_piece and make_move
+        self.hash = self.compute_hash()
+        # The legal moves of the player to move, worked out when first needed in each
+        # position (see legal_move_index), and forgotten whenever the position changes
+        self.legal_index = None
+        self.legal_set = None
+        # Number of pieces on the board, e.g. for deciding when to look in the tablebases
+        self.piece_count = self.count_pieces()
+        # The piece code (see piece_logic) on each square, or 0 if it is empty, kept up to
+        # date by set_piece; a flat copy of the board for code which doesn't need the pieces
+        self.squares = self.square_codes()
+        self.new_history()
+
+    def init_cells(self):
+        self.cells = []
+        for r in range(self.size):
+            self.cells.append([])
+            for c in range(self.size):
+                self.cells[r].append(Cell([r,c]))
+        # The same cells indexed by square number (r*8 + c), as used in encoded moves
+        self.square_cells = [cell for row in self.cells for cell in row]
+
+    def init_pieces(self):
+        for r in range(self.size):
+            for c in range(self.size):
+                cell = self.cells[r][c]
+
+                if r < 2: colour = "b"
+                else: colour = "w"
+
+                if r == 0 or r == self.size-1:
+                    if c == 0 or c == self.size-1: cell.piece = Rook(self, cell, colour, [r,c])
+                    elif c == 1 or c == self.size-2: cell.piece = Knight(self, cell, colour, [r,c])
+                    elif c == 2 or c == self.size-3: cell.piece = Bishop(self, cell, colour, [r,c])
+                    elif c == 4:
+                        cell.piece = King(self, cell, colour, [r,c])
+                        self.kings[colour] = cell.piece
+                    elif c == 3: cell.piece = Queen(self, cell, colour, [r,c])
+                elif r == 1 or r == self.size-2:
+                    cell.piece = Pawn(self, cell, colour, [r,c])
+
+    # The attack maps hold, for each side, the set of its pieces attacking each cell.
+    # They are built once here and then kept up to date by set_piece.
+    def init_attacks(self):
+        self.attack_maps = {}
+        for colour in ("w", "b"):
+            self.attack_maps[colour] = [[set() for c in range(self.size)] for r in range(self.size)]
+        for row in self.cells:
+            for cell in row:
+                if cell.piece != None: self.add_attacks(cell.piece)
+
+    def add_attacks(self, piece):
+        piece.attacks = piece.get_attacks()
+        attack_map = self.attack_maps[piece.colour]
+        for location in piece.attacks:
+            attack_map[location[0]][location[1]].add(piece)
+
+    def remove_attacks(self, piece):
+        attack_map = self.attack_maps[piece.colour]
+        for location in piece.attacks:
+            attack_map[location[0]][location[1]].discard(piece)
+        piece.attacks = []
+
+    # Every change to the contents of a cell goes through here, so that the attack
+    # maps only need updating for the pieces involved: the piece leaving or arriving,
+    # and any sliding piece whose line of attack runs through the cell.
+    def set_piece(self, cell, piece):
+        old_piece = cell.piece
+        if old_piece == piece: return
+        self.legal_index = None
+        if old_piece == None: self.piece_count += 1
+        elif piece == None: self.piece_count -= 1
+        if old_piece != None: self.remove_attacks(old_piece)
+
+        cell.piece = piece
+        if self.bitboards != None: self.bitboards.set_square(cell.location, old_piece, piece)
+        sq = cell.location[0]*8 + cell.location[1]
+        if old_piece != None: self.hash ^= piece_keys[old_piece.colour][old_piece.kind][sq]
+        if piece != None: self.hash ^= piece_keys[piece.colour][piece.kind][sq]
+        self.squares[sq] = piece.code if piece != None else 0
+        if piece != None:
+            piece.cell = cell
+            piece.location = cell.location
+            self.add_attacks(piece)
+
+        r, c = cell.location[0], cell.location[1]
+        for colour in self.attack_maps:
+            for attacker in list(self.attack_maps[colour][r][c]):
+                if not attacker.is_bounded and attacker != piece:
+                    self.remove_attacks(attacker)
+                    self.add_attacks(attacker)
+
+    def is_square_attacked(self, location, by_colour):
+        return len(self.attack_maps[by_colour][location[0]][location[1]]) > 0
+
+    def attackers(self, location, by_colour):
+        return [piece.location for piece in self.attack_maps[by_colour][location[0]][location[1]]]
+
+    # Work out the Zobrist key from scratch. The en passant file only counts if a pawn
+    # of the player to move could take en passant, so that positions which can't be
+    # told apart get the same key.
+    def compute_hash(self):
+        key = 0
+        for sq, cell in enumerate(self.square_cells):
+            if cell.piece != None: key ^= piece_keys[cell.piece.colour][piece_kinds[cell.piece.name["w"]]][sq]
+        if self.active_player == "b": key ^= black_to_move_key
+        return key ^ castling_keys[self.castling_rights] ^ self.ep_key()
+
+    def ep_key(self):
+        if self.ep_square == None: return 0
+        r, c = self.ep_square[0], self.ep_square[1]
+        # The pawn which moved two squares is next to any pawns which could take it
+        pawn_row = r + 1 if r < self.size // 2 else r - 1
+        for capture_c in (c - 1, c + 1):
+            if 0 <= capture_c < self.size:
+                piece = self.cells[pawn_row][capture_c].piece
+                if piece != None and piece.name["w"] == "♙" and piece.colour == self.active_player:
+                    return ep_file_keys[c]
+        return 0
+
+    # The number of pieces on the board, worked out from scratch (see piece_count)
+    def count_pieces(self):
+        return sum(1 for cell in self.square_cells if cell.piece != None)
+
+    # The piece code of every square, worked out from scratch (see squares)
+    def square_codes(self):
+        return bytearray(cell.piece.code if cell.piece != None else 0 for cell in self.square_cells)
+
+    # How many times the current position has occurred, going back through the
+    # moves since the last capture or pawn move (which can't be repeated), or
+    # back to the position loaded, if the clock started above zero
+    def repetitions(self):
+        count = 1
+        for record in self.move_history[max(0, len(self.move_history) - self.halfmove_clock):]:
+            if record[6] == self.hash: count += 1
+        return count
+
+    def opponent(self, player):
+        if player == "w": return "b"
+        else: return "w"
+
+    # Listeners are called as listener(event, *args), where event is one of
+    # "cell" (a cell's contents changed), "checkmate" (the given player has lost)
+    # or "stalemate" (the given player has no moves, so the game is drawn).
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def cell_changed(self, cell):
+        self.notify("cell", cell)
+
+    # The legal moves of the player to move, as a dict from each square (r*8 + c) with a
+    # piece which can move to the set of squares it can move to. It is worked out once
+    # per position, along with legal_set (the same moves encoded), for clicks and move_handler.
+    def legal_move_index(self):
+        if self.legal_index == None:
+            index = {}
+            moves = self.legal_moves() if self.active_player != None else []
+            for move in moves:
+                index.setdefault(move & 63, set()).add(move >> 6 & 63)
+            self.legal_set = set(moves)
+            self.legal_index = index
+        return self.legal_index
+
+    # Squares the piece can legally move to, if it belongs to the player to move
+    def legal_destinations(self, piece):
+        return self.legal_move_index().get(piece.location[0]*8 + piece.location[1], set())
+
+    # Absolute locations the piece could move to, ignoring whether it leaves its king in check
+    def valid_locations(self, piece):
+        return [[move[0] + piece.location[0], move[1] + piece.location[1]] for move in piece.get_moves()]
+
+    def is_promotion(self, piece, location):
+        return piece.name["w"] == "♙" and (location[0] == 0 or location[0] == self.size-1)
+
+    # Pieces for each letter of a FEN piece placement; upper case is white
+    fen_pieces = {"p": Pawn, "n": Knight, "b": Bishop, "r": Rook, "q": Queen, "k": King}
+    # Castling right flags for each letter of a FEN castling field, in FEN order
+    fen_castling = {"K": WHITE_KINGSIDE, "Q": WHITE_QUEENSIDE, "k": BLACK_KINGSIDE, "q": BLACK_QUEENSIDE}
+
+    # Replace the position with a FEN piece placement (e.g. "rnbqkbnr/pppppppp/8/...")
+    # and clear the history. Kings and rooks on their starting squares are taken to
+    # be able to castle.
+    def load_placement(self, placement, active_player="w"):
+        rows = placement.split("/")
+        if len(rows) != self.size:
+            raise ValueError("Expected {} rows in placement: {}".format(self.size, placement))
+
+        codes = bytearray(self.size * self.size)
+        for r, row in enumerate(rows):
+            c = 0
+            for char in row:
+                if char.isdigit():
+                    c += int(char)
+                    continue
+                if char.lower() not in self.fen_pieces or c >= self.size:
+                    raise ValueError("Bad row in placement: {}".format(row))
+                codes[r*self.size + c] = self.fen_pieces[char.lower()].kind + 1 + (0 if char.isupper() else 8)
+                c += 1
+            if c != self.size:
+                raise ValueError("Bad row in placement: {}".format(row))
+
+        self.load_board(codes, active_player)
+        self.derive_castling_rights()
+        self.new_history()
+
+    # Replace the board with pieces made from a piece code for each square, and clear
+    # the history. The position state is reset, for the caller to fill in. Raises
+    # ValueError, leaving the position as it was, unless each side has one king.
+    def load_board(self, codes, active_player="w"):
+        for colour, code in (("w", King.kind + 1), ("b", King.kind + 9)):
+            if codes.count(code) != 1:
+                raise ValueError("Expected one {} king, found {}".format({"w": "white", "b": "black"}[colour], codes.count(code)))
+        self.init_cells()
+        self.kings = {"w": None, "b": None}
+        for sq, code in enumerate(codes):
+            if code == 0: continue
+            colour, piece_type = code_piece(code)
+            cell = self.square_cells[sq]
+            cell.piece = piece_type(self, cell, colour, cell.location)
+            if piece_type == King: self.kings[colour] = cell.piece
+
+        self.active_player = active_player
+        self.winner = None
+        self.move_history = []
+
+        self.castling_rights = 0
+        self.ep_square = None
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+
+        self.init_attacks()
+        if self.bitboards != None: self.bitboards.load(self)
+        self.hash = self.compute_hash()
+        self.legal_index = None
+        self.piece_count = self.count_pieces()
+        self.squares = self.square_codes()
+
+    # The current position as a Position, e.g. to keep it or send it to another process
+    def snapshot(self):
+        ep_square = self.ep_square[0]*8 + self.ep_square[1] if self.ep_square != None else None
+        return Position(bytes(self.squares), self.active_player, self.castling_rights, ep_square,
+            self.halfmove_clock, self.fullmove_number, self.hash)
+
+    # Replace the position with a snapshot, clearing the history as load_fen does.
+    # With keep_history the history tree is kept, for moving about in it (see goto_node).
+    def restore(self, position, keep_history=False):
+        self.load_board(position.board, position.active_player)
+        self.castling_rights = position.castling_rights
+        if position.ep_square != None: self.ep_square = list(divmod(position.ep_square, 8))
+        self.halfmove_clock = position.halfmove_clock
+        self.fullmove_number = position.fullmove_number
+        self.hash = self.compute_hash()
+        if not keep_history: self.new_history()
+
+    # A new Game in the same position, without the listeners, e.g. for a search in another
+    # thread. With history, it shares the undo records of the moves so far, so that
+    # repetitions of earlier positions are seen; those moves can't be taken back in it.
+    def copy(self, history=False):
+        game = Game(self.backend)
+        game.restore(self.snapshot())
+        if history:
+            game.move_history = list(self.move_history)
+            game.history_base = len(game.move_history)
+        return game
+
+    # Start a new history tree at the current position. history_node is the node of
+    # the current position, and history_base the number of records in move_history
+    # up to it; records after that (from make_move called directly) are added to the
+    # tree by sync_history when it is next used.
+    def new_history(self):
+        self.history_root = HistoryNode(None, None, 0, self.snapshot())
+        self.history_node = self.history_root
+        self.history_base = len(self.move_history)
+
+    def sync_history(self):
+        while self.history_base > len(self.move_history) and self.history_node.parent != None:
+            self.history_node = self.history_node.parent
+            self.history_base -= 1
+        for record in self.move_history[self.history_base:]:
+            self.history_node = self.history_node.child(record[0])
+        self.history_base = len(self.move_history)
+        # Keep the position, if its ply is one that keeps positions
+        node = self.history_node
+        if node.position == None and node.ply % self.snapshot_interval == 0: node.position = self.snapshot()
+
+    # Plies played since the position was loaded
+    def ply(self):
+        self.sync_history()
+        return self.history_node.ply
+
+    # The first position of the history and the moves from it to the current position
+    def line(self):
+        self.sync_history()
+        return self.history_root.position, [node.move for node in self.history_node.path()[1:]]
+
+    # Go to ply n of the current line: back through the moves played, or forward along
+    # the moves redo would play. Returns False if the line doesn't reach that far.
+    def goto_ply(self, n):
+        self.sync_history()
+        node = self.history_node
+        while node != None and node.ply > n: node = node.parent
+        while node != None and node.ply < n: node = node.next
+        if node == None: return False
+        self.goto_node(node)
+        return True
+
+    # The last ply of the current line
+    def line_end(self):
+        self.sync_history()
+        node = self.history_node
+        while node.next != None: node = node.next
+        return node.ply
+
+    # Make the position that of a node in the history tree. A few moves back are simply
+    # taken back; otherwise the nearest kept position on the way to the node is restored
+    # and the rest of the moves replayed, so any ply costs at most snapshot_interval
+    # moves (plus enough to see repetitions). Listeners are told once, with a
+    # "position" event, rather than about each cell.
+    def goto_node(self, target):
+        self.sync_history()
+        if self.active_player == None and self.move_history != []:
+            self.active_player = self.opponent(self.move_history[-1][1].colour)
+        self.winner = None
+
+        steps_back = self.history_node.ply - target.ply
+        if self.active_player != None and 0 <= steps_back <= min(len(self.move_history), self.snapshot_interval) \
+                and target in self.history_node.path():
+            for i in range(steps_back): self.unmake_move()
+        else:
+            path = target.path()
+            self.replay_path(path, target.ply)
+            # Repetitions are only seen in move_history, so go back far enough for them
+            if self.halfmove_clock > len(self.move_history):
+                self.replay_path(path, target.ply - self.halfmove_clock)
+        for node in target.path()[1:]: node.parent.next = node
+        self.history_node = target
+        self.history_base = len(self.move_history)
+        self.notify("position")
+
+    # Restore the last kept position on the path at or before ply, and replay the path from it
+    def replay_path(self, path, ply):
+        start = 0
+        for i, node in enumerate(path):
+            if node.ply > ply: break
+            if node.position != None: start = i
+        self.restore(path[start].position, keep_history=True)
+        for node in path[start + 1:]:
+            self.make_move(node.move)
+            if node.position == None and node.ply % self.snapshot_interval == 0: node.position = self.snapshot()
+
+    # The moves which have been played from the current position, with the one redo
+    # follows first
+    def variations(self):
+        self.sync_history()
+        node = self.history_node
+        return [node.next.move] + [child.move for child in node.children if child != node.next] if node.next != None else []
+
+    # Make redo follow the next of the moves played from the current position, and return it
+    def switch_variation(self):
+        self.sync_history()
+        node = self.history_node
+        if node.next == None: return None
+        node.next = node.children[(node.children.index(node.next) + 1) % len(node.children)]
+        return node.next.move
+
+    # Replace the position with one in Forsyth-Edwards Notation: piece placement,
+    # player to move, castling rights, en passant square, halfmove clock and fullmove
+    # number. Fields after the placement may be left out; missing castling rights
+    # are worked out as in load_placement. Castling rights given for a king or rook
+    # which isn't on its starting square are dropped. Raises ValueError for a FEN
+    # which isn't a legal position, leaving the game as it was.
+    def load_fen(self, fen):
+        saved = (self.snapshot(), self.winner, self.move_history, self.history_root, self.history_node, self.history_base)
+        try:
+            self.read_fen(fen)
+        except ValueError:
+            position, winner, move_history, history_root, history_node, history_base = saved
+            self.restore(position, keep_history=True)
+            self.active_player, self.winner, self.move_history = position.active_player, winner, move_history
+            self.history_root, self.history_node, self.history_base = history_root, history_node, history_base
+            raise
+
+    def read_fen(self, fen):
+        fields = fen.split()
+        if fields == [] or len(fields) > 6:
+            raise ValueError("Bad FEN: {}".format(fen))
+        fields += [None] * (6 - len(fields))
+        placement, active_player, castling, ep_square, halfmove_clock, fullmove_number = fields
+
+        if active_player == None: active_player = "w"
+        if active_player not in ("w", "b"):
+            raise ValueError("Bad player to move in FEN: {}".format(fen))
+        self.load_placement(placement, active_player)
+
+        if castling != None:
+            rights = 0
+            for char in castling:
+                if char == "-": continue
+                if char not in self.fen_castling:
+                    raise ValueError("Bad castling rights in FEN: {}".format(fen))
+                rights |= self.fen_castling[char]
+            self.castling_rights &= rights
+        if ep_square != None and ep_square != "-":
+            self.ep_square = name_location(ep_square)
+            if not self.valid_ep_square():
+                raise ValueError("Bad en passant square in FEN: {}".format(fen))
+        try:
+            if halfmove_clock != None: self.halfmove_clock = int(halfmove_clock)
+            if fullmove_number != None: self.fullmove_number = int(fullmove_number)
+        except ValueError:
+            raise ValueError("Bad move clocks in FEN: {}".format(fen))
+        self.hash = self.compute_hash()
+        self.legal_index = None
+        self.new_history()
+        if self.in_check(self.opponent(active_player)):
+            raise ValueError("Player not to move is in check in FEN: {}".format(fen))
+
+    # Could a pawn have just moved two squares over ep_square? It must be on the row the
+    # opponent's pawns skip (rank 6 with white to move, rank 3 with black), empty, with
+    # the opponent's pawn in front of it and the square that pawn came from empty.
+    def valid_ep_square(self):
+        r, c = self.ep_square[0], self.ep_square[1]
+        if self.active_player == "w": skipped_row, step = 2, 1
+        else: skipped_row, step = self.size - 3, -1
+        pawn = self.cells[r + step][c].piece if r == skipped_row else None
+        return (pawn != None and pawn.name["w"] == "♙" and pawn.colour != self.active_player
+            and self.cells[r][c].piece == None and self.cells[r - step][c].piece == None)
+
+    # The position in Forsyth-Edwards Notation
+    def fen(self):
+        rows = []
+        for row in self.cells:
+            text, empty = "", 0
+            for cell in row:
+                if cell.piece == None:
+                    empty += 1
+                    continue
+                if empty: text += str(empty)
+                empty = 0
+                letter = "pnbrqk"[piece_kinds[cell.piece.name["w"]]]
+                text += letter.upper() if cell.piece.colour == "w" else letter
+            if empty: text += str(empty)
+            rows.append(text)
+
+        # Once the game is over there is no active player, but the loser is still to move
+        player = self.active_player
+        if player == None:
+            if self.move_history != []: player = self.opponent(self.move_history[-1][1].colour)
+            else: player = "w"
+
+        castling = "".join(char for char in self.fen_castling if self.castling_rights & self.fen_castling[char])
+        ep_square = location_name(self.ep_square) if self.ep_square != None else "-"
+        return "{} {} {} {} {} {}".format("/".join(rows), player, castling or "-", ep_square,
+            self.halfmove_clock, self.fullmove_number)
+
+    # Give castling rights to each king and rook which are on their starting squares,
+    # and take them from any which aren't (e.g. after setup_tools has moved pieces).
+    # The position's key changes with them.
+    def derive_castling_rights(self):
+        self.castling_rights = 0
+        for colour in self.kings:
+            king = self.kings[colour]
+            if king == None or king.location != [king.home_row(), 4]: continue
+            for wing, c in (("king", self.size-1), ("queen", 0)):
+                rook = self.cells[king.location[0]][c].piece
+                if king.can_castle_with(rook): self.castling_rights |= castling_flags[colour][wing]
+        self.hash = self.compute_hash()
+        self.legal_index = None
+
+    # Encode the move of piece to location (see bitboard_logic), working out its flags.
+    # promotion is the kind a pawn promotes to, or 0.
+    def encode_move(self, piece, location, promotion=0):
+        r, c = piece.location[0], piece.location[1]
+        flags = 0
+        if piece.name["w"] == "♙":
+            if abs(location[0] - r) == 2: flags = DOUBLE_PUSH
+            elif location == self.ep_square and location[1] != c: flags = EN_PASSANT
+        elif piece.name["w"] == "♔" and abs(location[1] - c) == 2:
+            flags = CASTLE
+        return (r*8 + c) | (location[0]*8 + location[1]) << 6 | promotion << 12 | flags << 15
+
+    # All moves for the player which follow the pieces' rules, as encoded moves, with
+    # one move for each promotion choice. These may leave the player's king in check.
+    def pseudo_moves(self, player=None):
+        if player == None: player = self.active_player
+
+        if self.bitboards != None:
+            ep_square = None
+            if self.ep_square != None and player == self.active_player:
+                ep_square = self.ep_square[0]*8 + self.ep_square[1]
+            moves = self.bitboards.generate_moves(player, ep_square)
+            king = self.kings[player]
+            for move in king.castling_moves():
+                moves.append(self.encode_move(king, [king.location[0], king.location[1] + move[1]]))
+            return moves
+
+        moves = []
+        for cell in self.square_cells:
+            piece = cell.piece
+            if piece == None or piece.colour != player: continue
+            for location in self.valid_locations(piece):
+                if self.is_promotion(piece, location):
+                    for kind in promotion_pieces:
+                        moves.append(self.encode_move(piece, location, kind))
+                else:
+                    moves.append(self.encode_move(piece, location))
+        return moves
+
+    # The lines a king can be attacked along, with the sliding piece (besides the
+    # queen) which attacks along each
+    king_lines = [([1,0], "♖"), ([-1,0], "♖"), ([0,1], "♖"), ([0,-1], "♖"),
+                  ([1,1], "♗"), ([-1,-1], "♗"), ([1,-1], "♗"), ([-1,1], "♗")]
+
+    # Work out, once per position, what limits the player's moves. Returns
+    # (checkers, check_mask, pins, unsafe) where checkers are the pieces giving check,
+    # check_mask is the set of squares any piece but the king must move to in order to
+    # stop a single check (None when not in check), pins maps the square of each pinned
+    # piece to the squares it can still move to, and unsafe holds the squares behind the
+    # king on a sliding piece's line of check, which the king's own body hides in the
+    # attack maps.
+    def king_safety(self, player):
+        king = self.kings[player]
+        kr, kc = king.location[0], king.location[1]
+        enemy = self.opponent(player)
+
+        checkers = list(self.attack_maps[enemy][kr][kc])
+        check_mask = None
+        if len(checkers) == 1:
+            check_mask = {checkers[0].location[0]*8 + checkers[0].location[1]}
+
+        pins = {}
+        unsafe = set()
+        for (dr, dc), slider in self.king_lines:
+            ray = []
+            pinned = None
+            r, c = kr + dr, kc + dc
+            while 0 <= r < self.size and 0 <= c < self.size:
+                ray.append(r*8 + c)
+                piece = self.cells[r][c].piece
+                if piece != None:
+                    if piece.colour == player:
+                        # A second piece of our own on the line means nothing is pinned
+                        if pinned != None: break
+                        pinned = piece
+                    else:
+                        if piece.name["w"] == slider or piece.name["w"] == "♕":
+                            if pinned != None:
+                                pins[pinned.location[0]*8 + pinned.location[1]] = set(ray)
+                            else:
+                                if check_mask != None: check_mask.update(ray)
+                                if 0 <= kr - dr < self.size and 0 <= kc - dc < self.size:
+                                    unsafe.add((kr - dr)*8 + kc - dc)
+                        break
+                r, c = r + dr, c + dc
+
+        return checkers, check_mask, pins, unsafe
+
+    # All legal moves for the player, as encoded moves. Rather than trying each move
+    # and looking for check, the pseudo-legal moves are filtered with the check mask
+    # and pins from king_safety; only en passant, which takes a piece off a different
+    # square, is still tried on the board.
+    def legal_moves(self, player=None):
+        if player == None: player = self.active_player
+        checkers, check_mask, pins, unsafe = self.king_safety(player)
+        king = self.kings[player]
+        king_sq = king.location[0]*8 + king.location[1]
+        enemy_map = self.attack_maps[self.opponent(player)]
+
+        # In double check only the king can move
+        if len(checkers) > 1:
+            candidates = [self.encode_move(king, location) for location in self.valid_locations(king)]
+        else:
+            candidates = self.pseudo_moves(player)
+
+        moves = []
+        for move in candidates:
+            frm, to = move & 63, move >> 6 & 63
+            if frm == king_sq:
+                if enemy_map[to >> 3][to & 7] or to in unsafe: continue
+            elif move >> 15 & EN_PASSANT:
+                if self.test_move_for_check(move): continue
+            else:
+                if check_mask != None and to not in check_mask: continue
+                if frm in pins and to not in pins[frm]: continue
+            moves.append(move)
+        return moves
+
+    def move_name(self, move):
+        return move_name(move)
+
+    # Make an encoded move, pushing an undo record onto move_history. The record is
+    # (move, piece moved, piece taken, castling rights, en passant square, halfmove clock,
+    # key) from before the move, which is all unmake_move needs to restore the position.
+    # Listeners are only told about the changed cells if draw is set.
+    def make_move(self, move, draw=False):
+        frm, to = move & 63, move >> 6 & 63
+        promotion, flags = move >> 12 & 7, move >> 15
+        from_cell, to_cell = self.square_cells[frm], self.square_cells[to]
+        piece = from_cell.piece
+        taken_piece = to_cell.piece
+
+        if flags & EN_PASSANT:
+            ep_cell = self.square_cells[(frm & ~7) | (to & 7)]
+            taken_piece = ep_cell.piece
+
+        self.move_history.append((move, piece, taken_piece, self.castling_rights,
+            self.ep_square, self.halfmove_clock, self.hash))
+        self.hash ^= castling_keys[self.castling_rights] ^ self.ep_key() ^ black_to_move_key
+
+        if flags & EN_PASSANT:
+            self.set_piece(ep_cell, None)
+            if draw: self.cell_changed(ep_cell)
+
+        self.set_piece(from_cell, None)
+        if promotion:
+            self.set_piece(to_cell, promotion_pieces[promotion](self, to_cell, piece.colour, to_cell.location))
+        else:
+            self.set_piece(to_cell, piece)
+
+        # Castling also moves the rook to the other side of the king
+        if flags & CASTLE:
+            rook_cell, rook_dest = self.castling_rook_cells(frm, to)
+            rook = rook_cell.piece
+            self.set_piece(rook_cell, None)
+            self.set_piece(rook_dest, rook)
+            if draw:
+                self.cell_changed(rook_cell)
+                self.cell_changed(rook_dest)
+
+        self.castling_rights &= ~(square_castling_flags[frm] | square_castling_flags[to])
+        if flags & DOUBLE_PUSH: self.ep_square = [(frm + to) >> 4, frm & 7]
+        else: self.ep_square = None
+        if piece.name["w"] == "♙" or taken_piece != None: self.halfmove_clock = 0
+        else: self.halfmove_clock += 1
+        if piece.colour == "b": self.fullmove_number += 1
+        self.switch_players()
+        self.hash ^= castling_keys[self.castling_rights] ^ self.ep_key()
+
+        if draw:
+            self.cell_changed(from_cell)
+            self.cell_changed(to_cell)
+
+    # Take back the last move made by make_move, and return it
+    def unmake_move(self, draw=False):
+        (move, piece, taken_piece, self.castling_rights, self.ep_square, self.halfmove_clock,
+            key) = self.move_history.pop()
+        frm, to = move & 63, move >> 6 & 63
+        flags = move >> 15
+        from_cell, to_cell = self.square_cells[frm], self.square_cells[to]
+
+        if flags & CASTLE:
+            rook_cell, rook_dest = self.castling_rook_cells(frm, to)
+            rook = rook_dest.piece
+            self.set_piece(rook_dest, None)
+            self.set_piece(rook_cell, rook)
+            if draw:
+                self.cell_changed(rook_cell)
+                self.cell_changed(rook_dest)
+
+        self.set_piece(to_cell, None)
+        self.set_piece(from_cell, piece)
+        if flags & EN_PASSANT:
+            ep_cell = self.square_cells[(frm & ~7) | (to & 7)]
+            self.set_piece(ep_cell, taken_piece)
+            if draw: self.cell_changed(ep_cell)
+        elif taken_piece != None:
+            self.set_piece(to_cell, taken_piece)
+
+        if piece.colour == "b": self.fullmove_number -= 1
+        self.switch_players()
+        self.hash = key
+
+        if draw:
+            self.cell_changed(from_cell)
+            self.cell_changed(to_cell)
+        return move
+
+    # The cells a castling rook moves from and to, for a king moving from frm to to
+    def castling_rook_cells(self, frm, to):
+        if to > frm: return self.square_cells[frm | 7], self.square_cells[to - 1]
+        else: return self.square_cells[frm & ~7], self.square_cells[to + 1]
+
+    # Returns True if the move was made, and False if it was refused because it
+    # isn't legal (e.g. it would leave the player's king in check). Callers which
+    # look for the end of the game themselves can skip the checkmate test with
+    # test_mate=False.
+    def move_handler(self, piece, cell, promotion=None, test_mate=True):
+        kind = 0
+        if self.is_promotion(piece, cell.location):
+            if promotion == None and self.promotion_handler != None:
+                promotion = self.promotion_handler(piece)
+            if promotion not in self.promotion_names: promotion = '4'
+            kind = self.promotion_kinds[promotion]
+
+        return self.play_move(self.encode_move(piece, cell.location, kind), test_mate)
+
+    # Play an encoded move (e.g. one chosen by the engine) as move_handler does: refuse
+    # it if it isn't legal, tell listeners about the changed cells, and look for the
+    # end of the game.
+    def play_move(self, move, test_mate=True):
+        piece = self.square_cells[move & 63].piece
+        self.legal_move_index()
+        if move not in self.legal_set:
+            return False
+        self.make_move(move, draw=True)
+        # The move joins the history tree, alongside any other taken back from here
+        self.sync_history()
+
+        # If the new player has no legal moves the game is over: checkmate if
+        # they are in check, and stalemate (a draw) if not
+        if test_mate and self.legal_move_index() == {}:
+            if self.in_check(self.active_player):
+                self.winner = piece.colour
+                self.notify("checkmate", self.active_player)
+            else:
+                self.notify("stalemate", self.active_player)
+            self.active_player = None
+
+        return True
+
+    def in_check(self, player):
+        return self.is_square_attacked(self.kings[player].location, self.opponent(player))
+
+    # Would the move leave the moving player's king in check?
+    def test_move_for_check(self, move):
+        player = self.square_cells[move & 63].piece.colour
+        self.make_move(move)
+        check = self.in_check(player)
+        self.unmake_move()
+        return check
+
+    def checkmate(self, player):
+        return self.in_check(player) and self.legal_moves(player) == []
+
+    def stalemate(self, player):
+        return not self.in_check(player) and self.legal_moves(player) == []
+
+    def can_castle(self, player, wing):
+        return self.castling_rights & castling_flags[player][wing] != 0
+
+    # Step one ply back or forward along the history tree. A move before the last
+    # restored position (see goto_node) is reached through goto_node.
+    def unredo_move(self, mode):
+        if self.active_player == None:
+            return False
+
+        self.sync_history()
+        node = self.history_node
+        if mode == "undo" and node.parent != None:
+            if self.move_history == []:
+                self.goto_node(node.parent)
+                return True
+            self.unmake_move(draw=True)
+        elif mode == "redo" and node.next != None:
+            self.make_move(node.next.move, draw=True)
+        else:
+            return False
+        self.sync_history()
+        return True
+
+    def switch_players(self):
+        self.legal_index = None
+        if self.active_player == "w":
+            self.active_player = "b"
+        else:
+            self.active_player = "w"
@@ -0,0 +1,128 @@
+from game_logic import Game
+from zobrist import TranspositionTable
+import setup_tools
+
+import argparse
+import json
+import sys
+import time
+
+# perft counts the leaf nodes of the legal move tree to a given depth. Comparing
+# the counts against known values checks move generation (castling, en passant,
+# promotion, pins and checks), and timing them measures its speed.
+
+# Reference positions from https://www.chessprogramming.org/Perft_Results as
+# (FEN, node counts for depth 1, 2, ...)
+reference_positions = {
+    "start": ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", [20, 400, 8902, 197281, 4865609]),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862, 4085603]),
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624]),
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467, 422333]),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379, 2103487]),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890, 3894594]),
+}
+
+# Node counts for the named positions in setup_tools.setups,
+# recorded from this implementation once it matched all the reference positions.
+setup_nodes = {
+    "checkmate1": [42, 675, 27532],
+    "check1": [37, 715, 25510],
+    "castle1": [48, 1553, 69897],
+    "promotion1": [33, 1069, 35097],
+    "en-passent1": [28, 725, 21734],
+}
+
+# If a transposition table is given, subtrees already counted (reached by a different
+# move order) are looked up by the position's key instead of being counted again.
+def perft(game, depth, table=None):
+    if depth <= 1:
+        if depth == 1: return len(game.legal_moves())
+        return 1
+
+    if table != None:
+        entry = table.probe(game.hash)
+        if entry != None and entry[0] == depth: return entry[1]
+
+    nodes = 0
+    for move in game.legal_moves():
+        game.make_move(move)
+        nodes += perft(game, depth-1, table)
+        game.unmake_move()
+
+    if table != None: table.store(game.hash, depth, nodes)
+    return nodes
+
+# perft split by the first move, for finding which move's subtree is wrong
+def divide(game, depth, table=None):
+    counts = {}
+    for move in game.legal_moves():
+        game.make_move(move)
+        counts[game.move_name(move)] = perft(game, depth-1, table)
+        game.unmake_move()
+    return counts
+
+def load_position(name, backend):
+    game = Game(backend)
+    if name in reference_positions:
+        fen, expected = reference_positions[name]
+    else:
+        fen, expected = setup_tools.setups[name], setup_nodes[name]
+    game.load_fen(fen)
+    return game, expected
+
+def run(names, depth, backend, as_json=False, show_divide=False, hash_mb=0):
+    failed = False
+    for name in names:
+        game, expected = load_position(name, backend)
+        for d in range(1, depth+1):
+            # A fresh table for each run, so that timings don't depend on the runs before
+            table = None
+            if hash_mb > 0: table = TranspositionTable(hash_mb)
+
+            start = time.perf_counter()
+            if show_divide and d == depth:
+                counts = divide(game, d, table)
+                nodes = sum(counts.values())
+            else:
+                counts = None
+                nodes = perft(game, d, table)
+            seconds = time.perf_counter() - start
+
+            if d <= len(expected): ok = nodes == expected[d-1]
+            else: ok = None
+            if ok == False: failed = True
+
+            result = {"position": name, "backend": backend, "hash_mb": hash_mb, "depth": d, "nodes": nodes,
+                "expected": expected[d-1] if d <= len(expected) else None, "ok": ok,
+                "seconds": round(seconds, 6), "nps": round(nodes / seconds) if seconds > 0 else None}
+            if counts != None: result["divide"] = counts
+
+            if as_json:
+                print(json.dumps(result))
+            else:
+                status = {True: "ok", False: "FAILED (expected {})".format(result["expected"]), None: "-"}[ok]
+                print("{:<12} depth {} {:>10} nodes {:>8.3f}s {:>9} nodes/s  {}".format(
+                    name, d, nodes, seconds, result["nps"] or 0, status))
+                if counts != None:
+                    for move_name in sorted(counts):
+                        print("    {}: {}".format(move_name, counts[move_name]))
+            sys.stdout.flush()
+    return not failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count and time legal move tree leaves (perft)")
+    parser.add_argument("--depth", type=int, default=3, help="maximum depth to search")
+    parser.add_argument("--position", type=str, action="append",
+                        choices=list(reference_positions) + list(setup_tools.setups),
+                        help="position to run (may be repeated; default all)")
+    parser.add_argument("--backend", type=str, default="mailbox", choices=["mailbox", "bitboard"],
+                        help="move generation backend")
+    parser.add_argument("--divide", action="store_true", help="show node counts for each first move")
+    parser.add_argument("--hash", type=float, default=0,
+                        help="transposition table size in MB, to skip repeated subtrees (default none)")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per result")
+    args = parser.parse_args()
+
+    names = args.position or list(reference_positions) + list(setup_tools.setups)
+    if not run(names, args.depth, args.backend, args.json, args.divide, args.hash):
+        sys.exit(1)
@@ -0,0 +1,249 @@
+from game_logic import Game, start_fen, location_name
+from bitboard_logic import piece_kinds, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, CASTLE
+
+import argparse
+import gzip
+import json
+import re
+import sys
+import time
+
+# Reading and writing games in Portable Game Notation. read_games streams games
+# from a file one at a time, so files of any size are read in constant memory, and
+# moves in Standard Algebraic Notation (SAN) are matched against Game.legal_moves.
+
+results = ("1-0", "0-1", "1/2-1/2", "*")
+
+header_re = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]\s*$')
+# Brace comments and variations may span lines, so they're tokens rather than whole matches
+token_re = re.compile(r"\{|\}|\(|\)|;|\$\d+|1-0|0-1|1/2-1/2|\*|\d+\.+|[^\s{}();]+")
+san_re = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+
+san_letters = {KNIGHT: "N", BISHOP: "B", ROOK: "R", QUEEN: "Q", KING: "K"}
+letter_kinds = {"N": KNIGHT, "B": BISHOP, "R": ROOK, "Q": QUEEN, "K": KING}
+
+def open_text(path):
+    if path == "-": return sys.stdin
+    if path.endswith(".gz"): return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+# Yield each game in the file as a dict of its "headers" (tag name to value),
+# "moves" (a list of SAN strings, without comments, variations or annotations),
+# "result" (the game termination marker, or None if it was missing) and "line" (the
+# line of the file the game starts on, counting from 1)
+def read_games(path):
+    f = open_text(path)
+    try:
+        headers, moves = {}, []
+        comment, variation = False, 0
+        start = None
+        for line_number, line in enumerate(f, 1):
+            if line.startswith("%"): continue
+            stripped = line.strip()
+            if not comment and stripped.startswith("["):
+                match = header_re.match(stripped)
+                if match:
+                    # A tag after movetext starts the next game, if the last one had no result
+                    if moves:
+                        yield {"headers": headers, "moves": moves, "result": None, "line": start}
+                        headers, moves, variation = {}, [], 0
+                        start = None
+                    if start == None: start = line_number
+                    headers[match.group(1)] = match.group(2).replace('\\"', '"').replace("\\\\", "\\")
+                    continue
+            if start == None and stripped: start = line_number
+
+            for token in token_re.findall(line):
+                if comment:
+                    if token == "}": comment = False
+                elif token == "{":
+                    comment = True
+                elif token == ";":
+                    break
+                elif token == "(":
+                    variation += 1
+                elif token == ")":
+                    variation = max(0, variation - 1)
+                # Variations, NAGs, move numbers and the "e.p." some add to en passant captures
+                elif variation or token[0] == "$" or token[0].isdigit() and token[-1] == "." or token == "e.p.":
+                    continue
+                elif token in results:
+                    yield {"headers": headers, "moves": moves, "result": token, "line": start}
+                    headers, moves = {}, []
+                    start = None
+                else:
+                    moves.append(token)
+        if moves or headers:
+            yield {"headers": headers, "moves": moves, "result": None, "line": start}
+    finally:
+        if f is not sys.stdin: f.close()
+
+# The encoded move for a SAN string in the game's current position. legal_moves
+# can be passed in if the caller already has them. Raises ValueError if the SAN is
+# malformed, or matches no legal move or more than one.
+def parse_san(game, san, legal_moves=None):
+    if legal_moves == None: legal_moves = game.legal_moves()
+    text = san.rstrip("+#!?")
+    cells = game.square_cells
+
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        kingside = len(text) == 3
+        for move in legal_moves:
+            if move >> 15 & CASTLE and ((move >> 6 & 63) > (move & 63)) == kingside: return move
+        raise ValueError("Illegal move: {}".format(san))
+
+    match = san_re.match(text)
+    if not match: raise ValueError("Bad move: {}".format(san))
+    letter, from_file, from_rank, to_name, promotion = match.groups()
+    kind = letter_kinds[letter] if letter else PAWN
+    to = (8 - int(to_name[1])) * 8 + "abcdefgh".index(to_name[0])
+    promotion_kind = letter_kinds[promotion] if promotion else 0
+
+    found = []
+    for move in legal_moves:
+        frm = move & 63
+        if (move >> 6 & 63) != to or (move >> 12 & 7) != promotion_kind: continue
+        if move >> 15 & CASTLE: continue
+        if piece_kinds[cells[frm].piece.name["w"]] != kind: continue
+        if from_file != None and "abcdefgh"[frm & 7] != from_file: continue
+        if from_rank != None and str(8 - (frm >> 3)) != from_rank: continue
+        found.append(move)
+    if len(found) == 1: return found[0]
+    if found == []: raise ValueError("Illegal move: {}".format(san))
+    raise ValueError("Ambiguous move: {}".format(san))
+
+# The SAN for an encoded legal move in the game's current position, including
+# "+" for check and "#" for checkmate
+def san_name(game, move, legal_moves=None):
+    if legal_moves == None: legal_moves = game.legal_moves()
+    cells = game.square_cells
+    frm, to = move & 63, move >> 6 & 63
+    kind = piece_kinds[cells[frm].piece.name["w"]]
+    capture = cells[to].piece != None or (kind == PAWN and (frm & 7) != (to & 7))
+
+    if move >> 15 & CASTLE:
+        san = "O-O" if to > frm else "O-O-O"
+    elif kind == PAWN:
+        san = ""
+        if capture: san = "abcdefgh"[frm & 7] + "x"
+        san += location_name(divmod(to, 8))
+        if move >> 12 & 7: san += "=" + san_letters[move >> 12 & 7]
+    else:
+        # Name the file, rank or both of the moving piece if another of the same kind could move there
+        others = [other & 63 for other in legal_moves if (other >> 6 & 63) == to and (other & 63) != frm
+            and piece_kinds[cells[other & 63].piece.name["w"]] == kind]
+        square = location_name(divmod(frm, 8))
+        if others == []: disambiguation = ""
+        elif all((other & 7) != (frm & 7) for other in others): disambiguation = square[0]
+        elif all((other >> 3) != (frm >> 3) for other in others): disambiguation = square[1]
+        else: disambiguation = square
+        san = san_letters[kind] + disambiguation + ("x" if capture else "") + location_name(divmod(to, 8))
+
+    game.make_move(move)
+    if game.in_check(game.active_player):
+        san += "#" if game.legal_moves() == [] else "+"
+    game.unmake_move()
+    return san
+
+# Replay a game from read_games, checking each move against the rules. Returns a
+# report with the number of plies replayed, the first illegal move (if any), the
+# end of the game on the board ("checkmate", "stalemate", "check" or None), and
+# how many moves were marked "+" or "#" wrongly (or not marked).
+def replay(record, backend="bitboard", game=None):
+    if game == None: game = Game(backend)
+    headers = record["headers"]
+    report = {"white": headers.get("White"), "black": headers.get("Black"),
+        "result": record["result"] or headers.get("Result"), "plies": 0,
+        "error": None, "final": None, "flag_errors": 0}
+
+    try:
+        game.load_fen(headers.get("FEN", start_fen))
+    except ValueError as e:
+        report["error"] = str(e)
+        return report
+
+    legal_moves = game.legal_moves()
+    for ply, san in enumerate(record["moves"]):
+        try:
+            move = parse_san(game, san, legal_moves)
+        except ValueError as e:
+            report["error"] = "ply {}: {}".format(ply + 1, e)
+            break
+        game.make_move(move)
+        report["plies"] += 1
+        legal_moves = game.legal_moves()
+        check = game.in_check(game.active_player)
+        mate = check and legal_moves == []
+        if san.rstrip("!?").endswith("#") != mate or (san.rstrip("!?").endswith("+") != (check and not mate)):
+            report["flag_errors"] += 1
+
+    if legal_moves == []:
+        report["final"] = "checkmate" if game.in_check(game.active_player) else "stalemate"
+    elif game.in_check(game.active_player):
+        report["final"] = "check"
+    report["fen"] = game.fen()
+    return report
+
+# The game's moves as PGN, from the first position of its history (see Game.line).
+# The moves are named on a separate Game, so the game itself is left as it was.
+def game_pgn(game, headers=None, result="*"):
+    start, moves = game.line()
+    scratch = Game(game.backend)
+    scratch.restore(start)
+
+    fen = scratch.fen()
+    tags = {"Event": "?", "Site": "?", "Date": "????.??.??", "Round": "?", "White": "?", "Black": "?"}
+    if headers != None: tags.update(headers)
+    tags["Result"] = result
+    if fen != start_fen:
+        tags["SetUp"], tags["FEN"] = "1", fen
+
+    words = []
+    for move in moves:
+        if scratch.active_player == "w": words.append("{}.".format(scratch.fullmove_number))
+        elif words == []: words.append("{}...".format(scratch.fullmove_number))
+        words.append(san_name(scratch, move))
+        scratch.make_move(move)
+    words.append(result)
+
+    # Movetext lines are kept under 80 characters
+    lines, line = [], ""
+    for word in words:
+        if line and len(line) + 1 + len(word) > 79:
+            lines.append(line)
+            line = word
+        else:
+            line = line + " " + word if line else word
+    lines.append(line)
+    tag_lines = ['[{} "{}"]'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in tags.items()]
+    return "\n".join(tag_lines) + "\n\n" + "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the games in PGN files (optionally gzip'd), checking every move")
+    parser.add_argument("files", nargs="+", help="PGN files, or - for standard input")
+    parser.add_argument("--backend", type=str, default="bitboard", choices=["mailbox", "bitboard"],
+                        help="move generation backend")
+    parser.add_argument("--json", action="store_true", help="print a JSON report for every game")
+    parser.add_argument("--quiet", action="store_true", help="only print the summary")
+    args = parser.parse_args()
+
+    game = Game(args.backend)
+    games = plies = bad = 0
+    start = time.perf_counter()
+    for path in args.files:
+        for record in read_games(path):
+            games += 1
+            report = replay(record, game=game)
+            report["game"] = games
+            plies += report["plies"]
+            if report["error"] != None: bad += 1
+            if args.json:
+                print(json.dumps(report))
+            elif report["error"] != None and not args.quiet:
+                print("game {} ({} - {}): {}".format(games, report["white"], report["black"], report["error"]))
+    seconds = time.perf_counter() - start
+
+    print("{} games, {} with illegal moves, {} plies in {:.2f}s ({:.1f} games/s, {:.0f} plies/s)".format(
+        games, bad, plies, seconds, games / seconds if seconds > 0 else 0, plies / seconds if seconds > 0 else 0),
+        file=sys.stderr)
+    if bad: sys.exit(1)
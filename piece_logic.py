@@ -1,55 +1,63 @@
+# Pieces only hold what differs between pieces of the same type (their board,
+# cell, colour and location), in __slots__. Everything else is shared by the type
+# in class attributes:
+# name holds the piece's glyph for each colour, and kind its number in bitboard_logic.
+# movements holds the moves that a particular piece can make, ignoring its location and surroundings
+# is_bounded is a flag which is True if the piece can only move one step, e.g. Knight, King, and False otherwise
+# code is the piece's small integer code in Game.squares: kind + 1, plus 8 for black.
 class Piece:
-    # Movements holds the moves that a particular piece can make, ignoring its location and surroundings
-    # is_bounded is a flag which is False if the piece can move an infinite distance, e.g. Queen, Bishop, Rook, and false otherwise
-    def __init__(self, board, cell, name, colour, location, movements, is_bounded, can_jump):
+    __slots__ = ("board", "cell", "colour", "location", "code", "attacks")
+
+    def __init__(self, board, cell, colour, location):
         self.board = board
         self.cell = cell
-        self.name = name
         self.colour = colour
         self.location = location
-        self.movements = movements
-        self.is_bounded = is_bounded
-        self.can_jump = can_jump
+        self.code = self.kind + 1 + (8 if colour == "b" else 0)
+        self.attacks = []
 
     def __str__(self):
         return self.name[self.colour]
 
-    def move(self, cell, draw=True, unredo=False):
-        # remove piece from current cell, and print
-        self.cell.piece = None
-        if draw: self.cell.update_entry()
-        if draw: self.cell.widget["bg"] = self.cell.orig_colour
+    # Returns (is this piece attacked?, locations of the enemy pieces attacking it),
+    # read from the board's attack maps
+    def is_threatened(self):
+        threats = self.board.attackers(self.location, self.board.opponent(self.colour))
+        return (threats != [], threats)
 
-        # set piece of destination, and print
-        cell.piece = self
-        if draw: cell.update_entry()
+    # Locations this piece attacks, including those occupied by its own side.
+    # Used to build the board's attack maps.
+    def get_attacks(self):
+        r, c = self.location[0], self.location[1]
+        cells = self.board.cells
+        size = self.board.size
+        attacks = []
 
-        # update cell and location attributes to destination
-        self.cell = cell
-        self.location = cell.location
+        if not self.is_bounded:
+            max_mult = size
+        else:
+            max_mult = 1
 
-    def is_threatened(self):
-        threatened = False
-        threats = []
-
-        for row in self.board.cells:
-            for cell in row:
-                if cell.piece == None:
-                    continue
-                if cell.piece.colour != self.colour:
-                    enemy_moves = cell.piece.get_moves()
-                    for move in enemy_moves:
-                        location = [cell.location[0]+move[0], cell.location[1]+move[1]]
-                        if location == self.location:
-                            threatened = True
-                            threats.append(cell.location)
-        return (threatened, threats)
+        for move in self.movements:
+            for move_mult in range(1, max_mult+1):
+                new_r, new_c = r + move[0]*move_mult, c + move[1]*move_mult
+                if new_r >= size or new_r < 0 or new_c >= size or new_c < 0: break
+                attacks.append([new_r, new_c])
+                # A piece in the way blocks any further movement in this direction
+                if cells[new_r][new_c].piece != None: break
+
+        return attacks
 
     def get_moves(self, moves=None, movements=None):
         r, c = self.location[0], self.location[1]
 
         if moves == None: moves = []
-        if movements == None: movements = self.movements.copy()
+
+        # The bitboard backend, if the board uses it, gives the same moves from lookup tables
+        if movements == None and self.board.bitboards != None:
+            return self.board.bitboards.piece_moves(self, moves)
+
+        if movements == None: movements = list(self.movements)
 
         if not self.is_bounded:
             max_mult = self.board.size
@@ -90,173 +98,151 @@ class Piece:
         return valid
 
 class Rook(Piece):
-    def __init__(self, board, cell, colour, location):
-        self.name = {"w": "♖", "b": "♜"}
-        self.movements = [[1,0], [-1,0], [0,1], [0,-1]]
-        self.is_bounded = False
-        self.can_jump = False
-        super().__init__(board, cell, self.name, colour, location, self.movements, self.is_bounded, self.can_jump)
+    __slots__ = ()
+    name = {"w": "♖", "b": "♜"}
+    kind = 3
+    movements = ((1,0), (-1,0), (0,1), (0,-1))
+    is_bounded = False
+    can_jump = False
 
 class Knight(Piece):
-    def __init__(self, board, cell, colour, location):
-        self.name = {"w": "♘", "b": "♞"}
-        self.movements = ([
-            [1,-2], [1,2], [2,-1], [2,1],
-            [-1,-2], [-1,2], [-2,-1], [-2,1]
-        ])
-        self.is_bounded = True
-        self.can_jump = True
-        super().__init__(board, cell, self.name, colour, location, self.movements, self.is_bounded, self.can_jump)
+    __slots__ = ()
+    name = {"w": "♘", "b": "♞"}
+    kind = 1
+    movements = ((1,-2), (1,2), (2,-1), (2,1),
+                 (-1,-2), (-1,2), (-2,-1), (-2,1))
+    is_bounded = True
+    can_jump = True
 
 class Bishop(Piece):
-    def __init__(self, board, cell, colour, location):
-        self.name = {"w": "♗", "b": "♝"}
-        self.movements = [[1,1], [-1,-1], [1,-1], [-1,1]]
-        self.is_bounded = False
-        self.can_jump = False
-        super().__init__(board, cell, self.name, colour, location, self.movements, self.is_bounded, self.can_jump)
+    __slots__ = ()
+    name = {"w": "♗", "b": "♝"}
+    kind = 2
+    movements = ((1,1), (-1,-1), (1,-1), (-1,1))
+    is_bounded = False
+    can_jump = False
 
 class King(Piece):
-    def __init__(self, board, cell, colour, location):
-        self.name = {"w": "♔", "b": "♚"}
-        self.movements = ([
-            [1,0], [-1,0], [0,1], [0,-1],
-            [1,1], [-1,-1], [1,-1], [-1,1]
-        ])
-        self.is_bounded = True
-        self.can_jump = False
-        super().__init__(board, cell, self.name, colour, location, self.movements, self.is_bounded, self.can_jump)
+    __slots__ = ()
+    name = {"w": "♔", "b": "♚"}
+    kind = 5
+    movements = ((1,0), (-1,0), (0,1), (0,-1),
+                 (1,1), (-1,-1), (1,-1), (-1,1))
+    is_bounded = True
+    can_jump = False
 
     def get_moves(self):
+        moves = self.castling_moves()
+        super().get_moves(moves)
+        return moves
+
+    def castling_moves(self):
         r, c = self.location[0], self.location[1]
 
         moves = []
 
-        moved_pieces = [move[0] for move_set in self.board.move_history for move in move_set]
-
-        moved_king = self in moved_pieces
-        if moved_king or (self.board.active_player == self.colour and self.is_threatened()[0]):
-            super().get_moves(moves)
+        # Castling needs the board's castling right for that wing (which is lost once
+        # the king or rook moves, or the rook is taken), and the king not to be in check
+        can_castle = {wing: self.board.can_castle(self.colour, wing) for wing in ("king", "queen")}
+        enemy = self.board.opponent(self.colour)
+        if not (can_castle["king"] or can_castle["queen"]) or self.board.is_square_attacked(self.location, enemy):
             return moves
 
-        rook_sq_piece = self.board.cells[r][c+3].piece
-        moved_rook = rook_sq_piece in moved_pieces
-        empty_between = self.board.cells[r][c+1].piece == None and self.board.cells[r][c+2].piece == None
-
-        if (empty_between and rook_sq_piece != None
-                and rook_sq_piece.name["w"] == "♖" and not moved_rook):
-            moves.append([0,-2])
+        # The king also can't pass through a square which is under attack
+        if can_castle["king"]:
+            empty_between = self.board.cells[r][c+1].piece == None and self.board.cells[r][c+2].piece == None
+            if empty_between and not self.board.is_square_attacked([r, c+1], enemy):
+                moves.append([0,2])
 
-        rook_sq_piece = self.board.cells[r][c-4].piece
-        moved_rook = rook_sq_piece in moved_pieces
-        empty_between = (self.board.cells[r][c-1].piece == None
-                        and self.board.cells[r][c-2].piece == None
-                        and self.board.cells[r][c-3].piece == None)
-        if (empty_between and rook_sq_piece != None
-                and rook_sq_piece.name["w"] == "♖" and not moved_rook):
-            moves.append([0,2])
+        if can_castle["queen"]:
+            empty_between = (self.board.cells[r][c-1].piece == None
+                            and self.board.cells[r][c-2].piece == None
+                            and self.board.cells[r][c-3].piece == None)
+            if empty_between and not self.board.is_square_attacked([r, c-1], enemy):
+                moves.append([0,-2])
 
-        super().get_moves(moves)
         return moves
 
-class Queen(Piece):
-    def __init__(self, board, cell, colour, location):
-        self.name = {"w": "♕", "b": "♛"}
-        self.movements = ([
-            [1,0], [-1,0], [0,1], [0,-1],
-            [1,1], [-1,-1], [1,-1], [-1,1]
-        ])
-        self.is_bounded = False
-        self.can_jump = False
-        super().__init__(board, cell, self.name, colour, location, self.movements, self.is_bounded, self.can_jump)
-
-class Pawn(Piece):
-    def __init__(self, board, cell, colour, location):
-        self.name = {"w": "♙", "b": "♟"}
-        self.orig_location = location
+    def home_row(self):
+        if self.colour == "w": return self.board.size-1
+        else: return 0
 
-        if location[0] < 2:
-            self.orig_movements = [[1,0], [2,0]]
-            self.takes = [[1,1], [1,-1]]
-        else:
-            self.orig_movements = [[-1,0], [-2,0]]
-            self.takes = [[-1,1], [-1,-1]]
+    def can_castle_with(self, rook):
+        return rook != None and rook.name["w"] == "♖" and rook.colour == self.colour
 
-        self.movements = self.orig_movements
+class Queen(Piece):
+    __slots__ = ()
+    name = {"w": "♕", "b": "♛"}
+    kind = 4
+    movements = ((1,0), (-1,0), (0,1), (0,-1),
+                 (1,1), (-1,-1), (1,-1), (-1,1))
+    is_bounded = False
+    can_jump = False
 
-        self.is_bounded = True
-        self.can_jump = False
-        self.prom_choice = None
-        super().__init__(board, cell, self.name, colour, location, self.movements, self.is_bounded, self.can_jump)
+class Pawn(Piece):
+    __slots__ = ()
+    name = {"w": "♙", "b": "♟"}
+    kind = 0
+    # Black pawns start at the top of the board (row 0) and move down
+    pawn_movements = {"b": ((1,0), (2,0)), "w": ((-1,0), (-2,0))}
+    pawn_takes = {"b": ((1,1), (1,-1)), "w": ((-1,1), (-1,-1))}
+    is_bounded = True
+    can_jump = False
+
+    @property
+    def takes(self):
+        return self.pawn_takes[self.colour]
 
     def get_moves(self):
-        if self.location == self.orig_location: self.movements = self.orig_movements
-        else: self.movements = [self.orig_movements[0]]
+        # Pawns on their starting row may move two squares
+        if self.colour == "w": start_row = self.board.size-2
+        else: start_row = 1
+        movements = self.pawn_movements[self.colour]
+        if self.location[0] != start_row: movements = movements[:1]
 
         r, c = self.location[0], self.location[1]
 
         moves = []
-        movements = self.movements.copy()
 
-        # Can't move onto piece in front
-        if r == self.board.size-1 or (self.board.cells[r+1][c].piece != None and [1,0] in movements):
-            movements.remove([1,0])
-        elif r == 0 or (self.board.cells[r-1][c].piece != None and [-1,0] in movements):
-            movements.remove([-1,0])
+        # En-passant
+        # If the latest move was a pawn moving 2 squares, then they can be taken en passant
+        # (According to chess rules, the opportunity to take en passant only lasts one turn)
+        # The board keeps the square that pawn skipped over in ep_square.
+        ep_square = self.board.ep_square
+        if ep_square != None and self.board.active_player == self.colour:
+            for move in self.takes:
+                if ep_square == [r + move[0], c + move[1]]: moves.append(move)
+
+        if self.board.bitboards != None:
+            return self.board.bitboards.piece_moves(self, moves)
+
         # Diagonals are valid if there is a piece there
         for move in self.takes:
             if self.is_valid_move(move, is_take=True)[0]: moves.append(move)
 
-        # En-passant
-        # If the latest move was a pawn moving 2 squares, then they can be taken en passant
-        # (According to chess rules, the opportunity to take en passant only lasts one turn)
-        move_hist = self.board.move_history
-        if move_hist != []:
-            last_piece = move_hist[-1][0][0]
-            lp_old_cell = move_hist[-1][0][1]
-            if last_piece.name["w"] == "♙" and abs(last_piece.location[0] - lp_old_cell.location[0]) == 2:
-                if last_piece.location == [self.location[0], self.location[1] + 1]:
-                    moves.append(self.takes[0])
-                elif last_piece.location == [self.location[0], self.location[1] - 1]:
-                    moves.append(self.takes[1])
+        # Can't move onto, or jump over, a piece in front
+        movements = list(movements)
+        for i, move in enumerate(movements):
+            new_r = r + move[0]
+            if new_r >= self.board.size or new_r < 0 or self.board.cells[new_r][c].piece != None:
+                movements = movements[:i]
+                break
 
         super().get_moves(moves, movements)
         return moves
 
-    def move(self, cell, draw=True, unredo=False):
-        taken_piece = cell.piece
-        move_made = [cell.location[0] - self.location[0], cell.location[1] - self.location[1]]
-
-        # If move is called by unredo and en passent, then update board
-        # If move is called by move handler, then this happens there as move history also needs to be updated
-        if taken_piece == None and move_made in self.takes and unredo:
-            taken_piece = self.board.cells[cell.location[0] - self.orig_movements[0][0]][cell.location[1]].piece
-            taken_piece.cell.piece = None
-            taken_piece.cell.update_entry()
-
-        super().move(cell, draw)
-        piece_names = {'1': "bishop", '2': "knight", '3': "rook", '4': "queen"}
-        piece_id = 0
-
-        # Promotion check and choice
-        if self.location[0] == 0 or self.location[0] == self.board.size-1:
-            if not unredo:
-                print("Pawn promotion!")
-                for id in piece_names:
-                    print("\t{}. {}".format(id, piece_names[id]))
-                while piece_id not in piece_names:
-                    piece_id = input("Enter a number for pawn promotion: ")
-                self.prom_choice = piece_id
-            else:
-                piece_id = self.prom_choice
-
-            if piece_id == '1':
-                cell.piece = Bishop(self.board, cell, self.board.active_player, cell.location)
-            elif piece_id == '2':
-                cell.piece = Knight(self.board, cell, self.board.active_player, cell.location)
-            elif piece_id == '3':
-                cell.piece = Rook(self.board, cell, self.board.active_player, cell.location)
-            elif piece_id == '4':
-                cell.piece = Queen(self.board, cell, self.board.active_player, cell.location)
-
-            cell.update_entry()
+    # Pawns only attack diagonally, whether or not there is a piece there
+    def get_attacks(self):
+        attacks = []
+        for move in self.takes:
+            new_r, new_c = self.location[0] + move[0], self.location[1] + move[1]
+            if 0 <= new_r < self.board.size and 0 <= new_c < self.board.size:
+                attacks.append([new_r, new_c])
+        return attacks
+
+# The piece type of each kind, as numbered in bitboard_logic
+piece_types = (Pawn, Knight, Bishop, Rook, Queen, King)
+
+# The colour and type of a piece code
+def code_piece(code):
+    return ("b" if code & 8 else "w"), piece_types[(code & 7) - 1]
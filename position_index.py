@@ -0,0 +1,248 @@
+from game_logic import Game, start_fen
+import pgn
+
+import argparse
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+# An on-disk index of the positions reached in collections of games, for finding
+# which games reached a position, what was played next and how those games ended.
+#
+# An index is a directory. games.jsonl has a line for each game indexed (its source
+# file, the line it starts on, players and result), and games.off the byte offset of
+# each of those lines, so a game is found by its number without reading the rest.
+# Positions are in segment files: each is a sorted array of fixed-size entries (the
+# position's Zobrist key, game number, move played from it, ply and result), written
+# once and never changed. Adding games writes new segments, so nothing is rebuilt;
+# a lookup binary-searches every segment through mmap. merge() combines the segments
+# into one, when there are many.
+
+entry_struct = struct.Struct("<QIIHBx")
+offset_struct = struct.Struct("<Q")
+segment_magic = b"CPI1"
+
+# The move of the entry for a game's last position, from which no move was played
+NO_MOVE = 0xFFFFFFFF
+
+# Results as stored in entries
+result_codes = {"1-0": 1, "1/2-1/2": 2, "0-1": 3}
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        if self.map == None or self.map[:4] != segment_magic:
+            raise ValueError("Not an index segment: {}".format(path))
+        self.count = (size - len(segment_magic)) // entry_struct.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def key_at(self, i):
+        return struct.unpack_from("<Q", self.map, len(segment_magic) + i * entry_struct.size)[0]
+
+    # (key, game, move, ply, result) for every entry with the key
+    def entries(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < key: lo = mid + 1
+            else: hi = mid
+        found = []
+        while lo < self.count:
+            entry = entry_struct.unpack_from(self.map, len(segment_magic) + lo * entry_struct.size)
+            if entry[0] != key: break
+            found.append(entry)
+            lo += 1
+        return found
+
+    # Every entry, in key order
+    def __iter__(self):
+        for i in range(self.count):
+            yield entry_struct.unpack_from(self.map, len(segment_magic) + i * entry_struct.size)
+
+class PositionIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.games_path = os.path.join(directory, "games.jsonl")
+        self.offsets_path = os.path.join(directory, "games.off")
+        self.segments = [Segment(path) for path in self.segment_paths()]
+
+    def close(self):
+        for segment in self.segments: segment.close()
+        self.segments = []
+
+    def segment_paths(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith("segment-") and name.endswith(".idx"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def game_count(self):
+        if not os.path.exists(self.offsets_path): return 0
+        return os.path.getsize(self.offsets_path) // offset_struct.size
+
+    def position_count(self):
+        return sum(segment.count for segment in self.segments)
+
+    # Write sorted entries as a new segment. It is written under a temporary name and
+    # then renamed, so readers only ever see whole segments.
+    def write_segment(self, entries):
+        paths = self.segment_paths()
+        number = int(os.path.basename(paths[-1])[8:-4]) + 1 if paths else 1
+        path = os.path.join(self.directory, "segment-{:06d}.idx".format(number))
+        with open(path + ".tmp", "wb") as f:
+            f.write(segment_magic)
+            for entry in entries: f.write(entry_struct.pack(*entry))
+        os.replace(path + ".tmp", path)
+        self.segments.append(Segment(path))
+        return path
+
+    # Replay the games in PGN files and add their positions, segment_size entries to a
+    # segment. Games with illegal moves are indexed up to the first one. Returns the
+    # number of games and positions added.
+    def add(self, paths, backend="bitboard", segment_size=1000000):
+        game = Game(backend)
+        entries = []
+        games = positions = 0
+        number = self.game_count()
+        with open(self.games_path, "ab") as games_file, open(self.offsets_path, "ab") as offsets_file:
+            for path in paths:
+                for record in pgn.read_games(path):
+                    headers = record["headers"]
+                    result = record["result"] or headers.get("Result")
+                    try:
+                        game.load_fen(headers.get("FEN", start_fen))
+                    except ValueError:
+                        continue
+                    code = result_codes.get(result, 0)
+
+                    ply = 0
+                    for san in record["moves"]:
+                        try:
+                            move = pgn.parse_san(game, san)
+                        except ValueError:
+                            break
+                        entries.append((game.hash, number, move, ply, code))
+                        game.make_move(move)
+                        ply += 1
+                    entries.append((game.hash, number, NO_MOVE, ply, code))
+                    positions += ply + 1
+
+                    info = {"source": path, "line": record["line"], "white": headers.get("White"),
+                        "black": headers.get("Black"), "date": headers.get("Date"), "result": result, "plies": ply}
+                    offsets_file.write(offset_struct.pack(games_file.tell()))
+                    games_file.write((json.dumps(info) + "\n").encode("utf-8"))
+                    number += 1
+                    games += 1
+
+                    if len(entries) >= segment_size:
+                        games_file.flush()
+                        offsets_file.flush()
+                        entries.sort()
+                        self.write_segment(entries)
+                        entries = []
+            # Games are written before the segments pointing to them
+            games_file.flush()
+            offsets_file.flush()
+            if entries:
+                entries.sort()
+                self.write_segment(entries)
+        return games, positions
+
+    # Combine all the segments into one, e.g. after many additions
+    def merge(self):
+        if len(self.segments) < 2: return
+        old = self.segments
+        self.segments = []
+        self.write_segment(heapq.merge(*old))
+        merged = self.segments
+        for segment in old:
+            segment.close()
+            os.remove(segment.path)
+        self.segments = merged
+
+    # The entries of every game which reached the position with the key
+    def entries(self, key):
+        found = []
+        for segment in self.segments: found.extend(segment.entries(key))
+        return found
+
+    # The game with the number, as written by add
+    def game(self, number):
+        with open(self.offsets_path, "rb") as f:
+            f.seek(number * offset_struct.size)
+            offset = offset_struct.unpack(f.read(offset_struct.size))[0]
+        with open(self.games_path, "rb") as f:
+            f.seek(offset)
+            info = json.loads(f.readline())
+        info["game"] = number
+        return info
+
+    # What was played from the game's position: a list of (move, games, white wins, draws,
+    # black wins), most played first, with None for the games which ended there. A game
+    # which reached the position more than once counts once for each move it played.
+    def move_stats(self, game):
+        stats = {}
+        seen = set()
+        for key, number, move, ply, code in self.entries(game.hash):
+            if move == NO_MOVE: move = None
+            if (move, number) in seen: continue
+            seen.add((move, number))
+            counts = stats.setdefault(move, [0, 0, 0, 0])
+            counts[0] += 1
+            if code: counts[code] += 1
+        return sorted(((move,) + tuple(counts) for move, counts in stats.items()), key=lambda stat: -stat[1])
+
+    # The numbers of the games which reached the game's position, and the ply they first reached it at
+    def games_reaching(self, game):
+        first = {}
+        for key, number, move, ply, code in self.entries(game.hash):
+            if number not in first or ply < first[number]: first[number] = ply
+        return sorted(first.items())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the positions of PGN games, or look a position up in an index")
+    parser.add_argument("index", help="index directory")
+    parser.add_argument("--add", type=str, nargs="+", default=None, help="PGN files (optionally gzip'd) to add")
+    parser.add_argument("--segment-size", type=int, default=1000000, help="positions per segment when adding")
+    parser.add_argument("--merge", action="store_true", help="combine the index's segments into one")
+    parser.add_argument("--fen", type=str, default=start_fen, help="position to look up")
+    parser.add_argument("--games", type=int, default=10, help="games reaching the position to list")
+    parser.add_argument("--backend", type=str, default="bitboard", choices=["mailbox", "bitboard"],
+                        help="move generation backend")
+    args = parser.parse_args()
+
+    index = PositionIndex(args.index)
+    if args.add != None:
+        start = time.perf_counter()
+        games, positions = index.add(args.add, args.backend, args.segment_size)
+        seconds = time.perf_counter() - start
+        print("{} games, {} positions added in {:.2f}s ({:.0f} positions/s)".format(games, positions, seconds,
+            positions / seconds if seconds > 0 else 0), file=sys.stderr)
+    if args.merge:
+        index.merge()
+    if args.add == None and not args.merge:
+        game = Game(args.backend)
+        game.load_fen(args.fen)
+        start = time.perf_counter()
+        stats = index.move_stats(game)
+        reaching = index.games_reaching(game)
+        seconds = time.perf_counter() - start
+        print("{} games, {} positions in {} segments; position found in {} games ({:.2f}ms)".format(index.game_count(),
+            index.position_count(), len(index.segments), len(reaching), seconds * 1000))
+        for move, count, white, draws, black in stats:
+            name = pgn.san_name(game, move) if move != None else "(end)"
+            print("{:8} {:7} games  +{} ={} -{}".format(name, count, white, draws, black))
+        for number, ply in reaching[:args.games]:
+            info = index.game(number)
+            print("game {} ({}:{}) {} - {} {} at ply {}".format(number, info["source"], info["line"],
+                info["white"], info["black"], info["result"], ply))
+    index.close()
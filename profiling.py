@@ -0,0 +1,87 @@
+import json
+import sys
+import time
+
+# Counters for the hot functions: calls, cumulative seconds and (for searches) nodes.
+# Nothing is measured until install() is called, which swaps timing wrappers in
+# for the functions on their classes; uninstall() puts the originals back, so an
+# uninstrumented run costs nothing. Counters are cumulative until reset(), and
+# dump() writes them as one line of JSON, e.g. once per move or per batch.
+
+# (module, class, method) of each instrumented function. A method overridden in a
+# subclass (e.g. Pawn.get_moves) is counted separately, and includes any time in
+# the method it overrides.
+hot_functions = [
+    ("piece_logic", "Piece", "get_moves"),
+    ("piece_logic", "Pawn", "get_moves"),
+    ("piece_logic", "King", "get_moves"),
+    ("game_logic", "Game", "pseudo_moves"),
+    ("game_logic", "Game", "king_safety"),
+    ("game_logic", "Game", "legal_moves"),
+    ("game_logic", "Game", "legal_move_index"),
+    ("game_logic", "Game", "in_check"),
+    ("game_logic", "Game", "test_move_for_check"),
+    ("game_logic", "Game", "make_move"),
+    ("game_logic", "Game", "unmake_move"),
+    ("game_logic", "Game", "set_piece"),
+    ("game_logic", "Game", "play_move"),
+    ("engine", "Engine", "search"),
+]
+
+# name -> [calls, seconds, nodes]
+counters = {}
+# (class, method name, original function) of each installed wrapper
+installed = []
+
+def counter(name):
+    if name not in counters: counters[name] = [0, 0.0, 0]
+    return counters[name]
+
+def wrap(name, function):
+    entry = counter(name)
+    clock = time.perf_counter
+
+    def timed(*args, **kwargs):
+        start = clock()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            entry[0] += 1
+            entry[1] += clock() - start
+        # Searches report the nodes they visited
+        if type(result) == dict and "nodes" in result: entry[2] += result["nodes"]
+        return result
+
+    timed.__name__ = function.__name__
+    timed.__wrapped__ = function
+    return timed
+
+def install():
+    if installed: return
+    for module_name, class_name, method in hot_functions:
+        cls = getattr(__import__(module_name), class_name)
+        function = cls.__dict__[method]
+        installed.append((cls, method, function))
+        setattr(cls, method, wrap(class_name + "." + method, function))
+
+def uninstall():
+    while installed:
+        cls, method, function = installed.pop()
+        setattr(cls, method, function)
+
+def reset():
+    for entry in counters.values():
+        entry[0], entry[1], entry[2] = 0, 0.0, 0
+
+# The counters of every function called since the last reset, as a dict for JSON
+def report():
+    return {name: {"calls": entry[0], "seconds": round(entry[1], 6), "nodes": entry[2]}
+        for name, entry in counters.items() if entry[0]}
+
+# Write the counters as one line of JSON, with any extra fields (e.g. the move), and
+# reset them if asked
+def dump(out=sys.stderr, reset_counters=True, **fields):
+    fields["counters"] = report()
+    out.write(json.dumps(fields) + "\n")
+    out.flush()
+    if reset_counters: reset()
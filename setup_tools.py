@@ -1,48 +1,23 @@
-# White pieces: ♔♕♖♗♘♙
-# Black pieces: ♚♛♜♝♞♟
+import os
 
-# Each entry in setups has a name as its key, and a list of moves as its value.
-# A move is a dict which specifies the piece to move, which piece it is
-# (i.e. Bishop 1 is the first Bishop we get to in the list of cells), the
-# piece's colour, and the location it should move to.
+# Each entry in setups has a name as its key, and a position in Forsyth-Edwards
+# Notation (see Game.load_fen) as its value.
 setups = ({
-    "checkmate1": ([
-        {"piece": "♕", "which": 1, "colour": "w", "location": [4,2]},
-        {"piece": "♗", "which": 1, "colour": "w", "location": [3,7]}
-    ]),
-    "check1": ([
-        {"piece": "♕", "which": 1, "colour": "w", "location": [5,3]}
-    ]),
-    "castle1": ([
-        {"piece": "♗", "which": 1, "colour": "w", "location": [5,1]},
-        {"piece": "♘", "which": 1, "colour": "w", "location": [5,2]},
-        {"piece": "♕", "which": 1, "colour": "w", "location": [5,4]},
-        {"piece": "♗", "which": 2, "colour": "w", "location": [5,5]},
-        {"piece": "♘", "which": 2, "colour": "w", "location": [5,6]},
-        {"piece": "♛", "which": 1, "colour": "b", "location": [5,3]}
-    ]),
-    "promotion1": ([
-        {"piece": "♜", "which": 1, "colour": "b", "location": [2,7]},
-        {"piece": "♙", "which": 1, "colour": "w", "location": [1,0]},
-        {"piece": "♖", "which": 1, "colour": "w", "location": [5,7]},
-        {"piece": "♟", "which": 1, "colour": "b", "location": [6,0]}
-    ]),
-    "en-passent1": ([
-        {"piece": "♙", "which": 4, "colour": "w", "location": [3,3]},
-        {"piece": "♟", "which": 4, "colour": "b", "location": [2,3]}
-    ])
+    "checkmate1": "rnbqkbnr/pppppppp/8/7B/2Q5/8/PPPPPPPP/RN2KBNR w KQkq - 0 1",
+    "check1": "rnbqkbnr/pppppppp/8/8/8/3Q4/PPPPPPPP/RNB1KBNR w KQkq - 0 1",
+    "castle1": "rnb1kbnr/pppppppp/8/8/8/1BNqQBN1/PPPPPPPP/R3K2R w KQkq - 0 1",
+    "promotion1": "1nbqkbnr/P1pppppp/7r/8/8/7R/pPPPPPPP/1NBQKBNR w Kk - 0 1",
+    "en-passent1": "rnbqkbnr/ppp1pppp/3p4/3P4/8/8/PPP1PPPP/RNBQKBNR w KQkq - 0 1"
 })
 
-def exec_move(board, move_info):
-    p_name, which, colour, location = move_info["piece"], move_info["which"], move_info["colour"], move_info["location"]
-    for row in board.cells:
-        for cell in row:
-            if (cell.piece != None
-                    and cell.piece.name[colour] == p_name
-                    and cell.piece.colour == colour):
-                which -= 1
-                if which == 0: cell.piece.move(board.cells[location[0]][location[1]])
+# Read a file with one FEN per line; blank lines and lines starting with # are skipped
+def read_fens(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() != "" and not line.startswith("#")]
 
-def setup_locations(board, move_dicts):
-    for move_dict in move_dicts:
-        exec_move(board, move_dict)
+# The positions for a setup given on the command line: the name of one of setups,
+# the name of a file of FENs, or a FEN string
+def setup_positions(setup):
+    if setup in setups: return [setups[setup]]
+    if os.path.isfile(setup): return read_fens(setup)
+    return [setup]
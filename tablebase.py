@@ -0,0 +1,348 @@
+from game_logic import Game
+from bitboard_logic import (piece_kinds, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KNIGHT_ATTACKS,
+    KING_ATTACKS, PAWN_ATTACKS, rook_attacks, bishop_attacks, queen_attacks, squares)
+
+import argparse
+import mmap
+import os
+import struct
+import time
+
+# Endgame tablebases for a king and one or two pieces against a lone king (KQK,
+# KRK, KPK, KBNK), built by retrograde analysis: starting from the checkmates,
+# work backwards through the positions which lead to them, one ply at a time, so
+# every position gets its exact distance to mate.
+#
+# Tables are built with the stronger side as white. A position's index is
+#   (((king_index * 64 + black_king) * 64 + piece1) * 64 + piece2) * 2 + black_to_move
+# where king_index numbers the squares the white king is moved into by symmetry:
+# the a1-d1-d4 triangle (10 squares) using all eight reflections and rotations of the
+# board, or files a-d (32 squares) with pawns, which only allow mirroring the files.
+#
+# A table file is a header followed by one byte per index: 0 for a draw (or an
+# impossible position), otherwise 1 + the number of plies to mate. An even
+# number of plies means the player to move is mated; odd means they mate.
+
+magic = b"CTB1"
+header_struct = struct.Struct(">4s8sI")
+
+materials = ("KQK", "KRK", "KPK", "KBNK")
+# The most pieces (kings included) in any table
+max_pieces = 4
+piece_letters = {"P": PAWN, "N": KNIGHT, "B": BISHOP, "R": ROOK, "Q": QUEEN}
+# The order pieces are named in a material, e.g. "KBNK" rather than "KNBK"
+letter_order = "QRBNP"
+
+# Symmetries of the board, as tables of where each square (r*8 + c) goes
+def _transform(flip_rows, flip_columns, transpose):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        if transpose: r, c = c, r
+        if flip_rows: r = 7 - r
+        if flip_columns: c = 7 - c
+        table.append(r*8 + c)
+    return table
+
+all_transforms = [_transform(rows, columns, transpose) for transpose in (False, True)
+    for rows in (False, True) for columns in (False, True)]
+file_transforms = [_transform(False, False, False), _transform(False, True, False)]
+
+def white_attacks(kind, sq, occupied):
+    if kind == PAWN: return PAWN_ATTACKS["w"][sq]
+    if kind == KNIGHT: return KNIGHT_ATTACKS[sq]
+    if kind == BISHOP: return bishop_attacks(sq, occupied)
+    if kind == ROOK: return rook_attacks(sq, occupied)
+    if kind == QUEEN: return queen_attacks(sq, occupied)
+    return KING_ATTACKS[sq]
+
+# The layout of one table
+class TableSpec:
+    def __init__(self, material):
+        if material not in materials:
+            raise ValueError("No tablebase for {} (only {})".format(material, ", ".join(materials)))
+        self.material = material
+        self.kinds = [piece_letters[letter] for letter in material[1:-1]]
+        self.pawns = PAWN in self.kinds
+        if self.pawns:
+            self.transforms = file_transforms
+            self.king_squares = [sq for sq in range(64) if sq & 7 <= 3]
+        else:
+            self.transforms = all_transforms
+            self.king_squares = [sq for sq in range(64) if sq & 7 <= 3 and 7 - (sq >> 3) <= (sq & 7)]
+        self.king_index = [-1] * 64
+        for i, sq in enumerate(self.king_squares): self.king_index[sq] = i
+        # The symmetries which move a white king on each square into the region. There
+        # are two for squares on the diagonal, and both are tried (see index).
+        self.king_transforms = [[table for table in self.transforms if self.king_index[table[sq]] >= 0]
+            for sq in range(64)]
+        self.size = len(self.king_squares) * 64 ** (1 + len(self.kinds)) * 2
+
+    # Index of a position, given the squares of the white king, black king and the
+    # white pieces (in the order of kinds), and whether black is to move. Positions
+    # which are reflections of each other must share an index, so when more than one
+    # symmetry applies the lowest index is used.
+    def index(self, white_king, black_king, pieces, black_to_move):
+        best = None
+        for table in self.king_transforms[white_king]:
+            i = self.king_index[table[white_king]] * 64 + table[black_king]
+            for sq in pieces: i = i * 64 + table[sq]
+            if best == None or i < best: best = i
+        return best * 2 + black_to_move
+
+    def decode(self, index):
+        black_to_move = index & 1
+        index >>= 1
+        pieces = []
+        for kind in self.kinds:
+            pieces.append(index & 63)
+            index >>= 6
+        pieces.reverse()
+        black_king = index & 63
+        return self.king_squares[index >> 6], black_king, pieces, black_to_move
+
+    # Every arrangement of the pieces, with the white king in its symmetry region
+    def positions(self):
+        for white_king in self.king_squares:
+            for black_king in range(64):
+                if len(self.kinds) == 1:
+                    for sq in range(64): yield white_king, black_king, [sq]
+                else:
+                    for sq1 in range(64):
+                        for sq2 in range(64): yield white_king, black_king, [sq1, sq2]
+
+    def is_valid(self, white_king, black_king, pieces):
+        occupied = 1 << white_king | 1 << black_king
+        for kind, sq in zip(self.kinds, pieces):
+            if occupied & 1 << sq: return False
+            if kind == PAWN and (sq < 8 or sq >= 56): return False
+            occupied |= 1 << sq
+        return not KING_ATTACKS[white_king] & 1 << black_king
+
+    def black_in_check(self, black_king, pieces, occupied):
+        for kind, sq in zip(self.kinds, pieces):
+            if white_attacks(kind, sq, occupied) & 1 << black_king: return True
+        return False
+
+    # The black king's legal moves which don't take a piece, and whether it can take one
+    def black_moves(self, white_king, black_king, pieces):
+        occupied = 1 << white_king
+        for sq in pieces: occupied |= 1 << sq
+        # Without the black king, so that it can't hide behind itself from a slider
+        moves, capture = [], False
+        for to in squares(KING_ATTACKS[black_king] & ~KING_ATTACKS[white_king] & ~(1 << white_king)):
+            attacked = False
+            for kind, sq in zip(self.kinds, pieces):
+                if sq != to and white_attacks(kind, sq, occupied) & 1 << to:
+                    attacked = True
+                    break
+            if attacked: continue
+            if occupied & 1 << to: capture = True
+            else: moves.append(to)
+        return moves, capture
+
+# Build the table for a material, returning its values as a bytearray. KPK needs
+# the KQK and KRK values for promotions, which are built first if not given.
+def generate(material, tables=None, log=None):
+    spec = TableSpec(material)
+    if tables == None: tables = {}
+    values = bytearray(spec.size)
+    start = time.perf_counter()
+
+    # Promotions lead into other tables; taking a piece always leaves a draw
+    promotion_specs = {}
+    if spec.pawns:
+        for kind, other in ((QUEEN, "KQK"), (ROOK, "KRK")):
+            if other not in tables: tables[other] = generate(other, tables, log)
+            promotion_specs[kind] = (TableSpec(other), tables[other])
+
+    # Checkmates are the first level; promotions which win are seeded at the level they win at
+    frontier = []
+    seeds = {}
+    for white_king, black_king, pieces in spec.positions():
+        if not spec.is_valid(white_king, black_king, pieces): continue
+        occupied = 1 << white_king | 1 << black_king
+        for sq in pieces: occupied |= 1 << sq
+        check = spec.black_in_check(black_king, pieces, occupied)
+
+        moves, capture = spec.black_moves(white_king, black_king, pieces)
+        if check and moves == [] and not capture:
+            i = spec.index(white_king, black_king, pieces, 1)
+            if values[i] == 0:
+                values[i] = 1
+                frontier.append(i)
+
+        if spec.pawns and not check:
+            pawn = spec.kinds.index(PAWN)
+            to = pieces[pawn] - 8
+            if pieces[pawn] < 16 and not occupied & 1 << to:
+                for kind in promotion_specs:
+                    other, other_values = promotion_specs[kind]
+                    value = other_values[other.index(white_king, black_king, [to], 1)]
+                    if value and (value - 1) % 2 == 0:
+                        i = spec.index(white_king, black_king, pieces, 0)
+                        seeds.setdefault(value, set()).add(i)
+
+    ply = 0
+    resolved = len(frontier)
+    while frontier or any(level > ply for level in seeds):
+        next_frontier = []
+        for i in frontier:
+            white_king, black_king, pieces, black_to_move = spec.decode(i)
+            if black_to_move:
+                # Black is mated here at ply: every white move into it wins one ply later
+                for prev_king, prev_pieces in white_unmoves(spec, white_king, black_king, pieces):
+                    j = spec.index(prev_king, black_king, prev_pieces, 0)
+                    if values[j] == 0:
+                        values[j] = ply + 2
+                        next_frontier.append(j)
+            else:
+                # White wins here: a black move into it loses if all the others do too
+                occupied = 1 << white_king | 1 << black_king
+                for sq in pieces: occupied |= 1 << sq
+                for prev in squares(KING_ATTACKS[black_king] & ~occupied & ~KING_ATTACKS[white_king]):
+                    j = spec.index(white_king, prev, pieces, 1)
+                    if values[j] == 0 and black_loses(spec, values, white_king, prev, pieces):
+                        values[j] = ply + 2
+                        next_frontier.append(j)
+        ply += 1
+        for i in seeds.pop(ply, ()):
+            if values[i] == 0:
+                values[i] = ply + 1
+                next_frontier.append(i)
+        frontier = next_frontier
+        resolved += len(frontier)
+
+    if log != None:
+        log("{}: {} entries, {} decisive, longest mate {} plies, {:.1f}s".format(material, spec.size,
+            resolved, ply - 1, time.perf_counter() - start))
+    return values
+
+# Positions with white to move from which a white move reaches this one
+def white_unmoves(spec, white_king, black_king, pieces):
+    occupied = 1 << white_king | 1 << black_king
+    for sq in pieces: occupied |= 1 << sq
+    empty = ~occupied
+    unmoves = []
+    for prev in squares(KING_ATTACKS[white_king] & empty & ~KING_ATTACKS[black_king]):
+        unmoves.append((prev, pieces))
+    for j, kind in enumerate(spec.kinds):
+        sq = pieces[j]
+        if kind == PAWN:
+            origins = 0
+            if sq < 48 and empty & 1 << (sq + 8):
+                origins |= 1 << (sq + 8)
+                if 32 <= sq < 40 and empty & 1 << (sq + 16): origins |= 1 << (sq + 16)
+        else:
+            origins = white_attacks(kind, sq, occupied) & empty
+        for prev in squares(origins):
+            unmoves.append((white_king, pieces[:j] + [prev] + pieces[j+1:]))
+
+    # Black can't have been left in check by its own move
+    legal = []
+    for prev_king, prev_pieces in unmoves:
+        prev_occupied = 1 << prev_king | 1 << black_king
+        for sq in prev_pieces: prev_occupied |= 1 << sq
+        if not spec.black_in_check(black_king, prev_pieces, prev_occupied): legal.append((prev_king, prev_pieces))
+    return legal
+
+# Black to move loses if it has moves, can't take a piece, and every move reaches
+# a position already known to be won for white
+def black_loses(spec, values, white_king, black_king, pieces):
+    moves, capture = spec.black_moves(white_king, black_king, pieces)
+    if capture or moves == []: return False
+    for to in moves:
+        if values[spec.index(white_king, to, pieces, 0)] == 0: return False
+    return True
+
+def write_table(path, material, values):
+    with open(path, "wb") as f:
+        f.write(header_struct.pack(magic, material.encode("ascii"), len(values)))
+        f.write(values)
+
+# Tables found in a directory, memory-mapped as they are first needed
+class Tablebases:
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError("No tablebase directory: {}".format(directory))
+        self.directory = directory
+        self.tables = {}
+
+    def table(self, material):
+        if material not in self.tables:
+            path = os.path.join(self.directory, material + ".ctb")
+            table = None
+            if material in materials and os.path.exists(path):
+                with open(path, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                file_magic, file_material, size = header_struct.unpack_from(data)
+                spec = TableSpec(material)
+                if file_magic != magic or file_material.rstrip(b"\0").decode("ascii") != material or size != spec.size:
+                    raise ValueError("Bad tablebase file: {}".format(path))
+                table = (spec, data)
+            self.tables[material] = table
+        return self.tables[material]
+
+    # The game's material as a table name with the stronger side first, and that side,
+    # or (None, None) if it isn't a king and pieces against a lone king
+    def material(self, game):
+        pieces = {"w": [], "b": []}
+        for cell in game.square_cells:
+            if cell.piece != None and cell.piece.name["w"] != "♔": pieces[cell.piece.colour].append(cell.piece)
+        if pieces["w"] and pieces["b"] or not pieces["w"] and not pieces["b"]: return None, None
+        strong = "w" if pieces["w"] else "b"
+        letters = sorted(("PNBRQ"[piece_kinds[piece.name["w"]]] for piece in pieces[strong]), key=letter_order.index)
+        return "K" + "".join(letters) + "K", strong
+
+    # ("win", "loss" or "draw", plies to mate) for the player to move, or None if
+    # there is no table for the position
+    def probe(self, game):
+        material, strong = self.material(game)
+        if material == None or game.castling_rights: return None
+        table = self.table(material)
+        if table == None: return None
+        spec, data = table
+
+        # Tables have the stronger side as white, so flip the board if it's black
+        flip = 0 if strong == "w" else 56
+        white_king = (game.kings[strong].location[0]*8 + game.kings[strong].location[1]) ^ flip
+        weak = game.opponent(strong)
+        black_king = (game.kings[weak].location[0]*8 + game.kings[weak].location[1]) ^ flip
+        pieces = []
+        used = set()
+        for kind in spec.kinds:
+            for cell in game.square_cells:
+                piece = cell.piece
+                sq = cell.location[0]*8 + cell.location[1]
+                if piece != None and piece.colour == strong and piece_kinds[piece.name["w"]] == kind and sq not in used:
+                    used.add(sq)
+                    pieces.append(sq ^ flip)
+                    break
+
+        value = data[header_struct.size + spec.index(white_king, black_king, pieces, game.active_player != strong)]
+        if value == 0: return ("draw", 0)
+        plies = value - 1
+        return ("loss" if plies % 2 == 0 else "win", plies)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate or probe endgame tablebases")
+    parser.add_argument("--dir", type=str, default="tablebases", help="directory of table files")
+    parser.add_argument("--generate", type=str, nargs="+", choices=materials, default=None,
+                        help="tables to generate")
+    parser.add_argument("--fen", type=str, default=None, help="position to probe")
+    args = parser.parse_args()
+
+    if args.generate != None:
+        os.makedirs(args.dir, exist_ok=True)
+        tables = {}
+        for material in args.generate:
+            if material not in tables: tables[material] = generate(material, tables, print)
+            write_table(os.path.join(args.dir, material + ".ctb"), material, tables[material])
+    if args.fen != None:
+        game = Game()
+        game.load_fen(args.fen)
+        result = Tablebases(args.dir).probe(game)
+        if result == None: print("No table for this position")
+        elif result[0] == "draw": print("Draw")
+        else: print("{} to move {}, mate in {} plies".format({"w": "White", "b": "Black"}[game.active_player],
+            {"win": "wins", "loss": "loses"}[result[0]], result[1]))
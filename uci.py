@@ -0,0 +1,228 @@
+from game_logic import Game, start_fen, move_name
+import engine
+import book
+import tablebase
+
+import argparse
+import sys
+import threading
+
+# The engine behind the Universal Chess Interface, for GUIs and tournament tools:
+# commands are read from stdin and answers written to stdout. Searches run in a
+# background thread, so commands like isready and stop are answered while the
+# engine thinks, and "info" lines are written after each finished iteration.
+# A command that can't be carried out (a bad number, a book that won't open) is
+# answered with an "info string" saying why, and the engine carries on.
+
+# An integer argument of a command
+def parse_int(word, name):
+    try:
+        return int(word)
+    except ValueError:
+        raise ValueError("bad value for {}: {}".format(name, word))
+
+class UciEngine:
+    name = "tkinter Chess"
+    author = "Jonathan Carpenter"
+
+    def __init__(self, out=sys.stdout, hash_mb=16, book_path=None, book_keys_path=None, tablebase_dir=None, backend="bitboard"):
+        self.out = out
+        self.lock = threading.Lock()
+        self.hash_mb = hash_mb
+        self.book_path = book_path
+        self.book_keys_path = book_keys_path
+        # The book and tablebases are opened when set, so a bad path is reported then
+        self.opening_book = self.open_book(book_path, book_keys_path)
+        self.tablebases = tablebase.Tablebases(tablebase_dir) if tablebase_dir else None
+        self.backend = backend
+        self.engine = None
+        self.game = Game(backend)
+
+        # The thread running the current search, and an event it waits on before
+        # sending bestmove from an infinite or ponder search, set by stop or ponderhit
+        self.search_thread = None
+        self.release = threading.Event()
+        # The time a ponder search gets once the opponent plays the expected move
+        self.ponder_movetime = None
+
+    def send(self, line):
+        with self.lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    def open_book(self, path, keys_path):
+        keys = book.load_keys(keys_path) if keys_path else book.default_keys
+        return book.PolyglotBook(path, keys) if path else None
+
+    # The engine is made when first needed, so options set before then are used
+    def get_engine(self):
+        if self.engine == None:
+            self.engine = engine.Engine(self.hash_mb, self.opening_book, tablebases=self.tablebases)
+        return self.engine
+
+    # Handle one command line; returns False for quit
+    def command(self, line):
+        words = line.split()
+        if words == []: return True
+        name, args = words[0], words[1:]
+
+        if name == "uci":
+            self.send("id name " + self.name)
+            self.send("id author " + self.author)
+            self.send("option name Hash type spin default 16 min 1 max 4096")
+            self.send("option name Ponder type check default false")
+            self.send("option name Book type string default <empty>")
+            self.send("option name BookKeys type string default <empty>")
+            self.send("option name Tablebases type string default <empty>")
+            self.send("uciok")
+        elif name == "isready":
+            self.send("readyok")
+        elif name == "setoption":
+            self.set_option(args)
+        elif name == "ucinewgame":
+            self.stop()
+            self.get_engine().table.clear()
+        elif name == "position":
+            self.stop()
+            self.set_position(args)
+        elif name == "go":
+            self.stop()
+            self.go(args)
+        elif name == "stop":
+            self.stop()
+        elif name == "ponderhit":
+            self.ponderhit()
+        elif name == "quit":
+            self.stop()
+            return False
+        elif name == "d":
+            self.send(self.game.fen())
+        else:
+            self.send("info string unknown command " + name)
+        return True
+
+    # setoption name <name> value <value>
+    def set_option(self, args):
+        if "name" not in args: return
+        value_at = args.index("value") if "value" in args else len(args)
+        option = " ".join(args[args.index("name") + 1:value_at]).lower()
+        value = " ".join(args[value_at + 1:])
+        if value == "<empty>": value = ""
+        self.stop()
+        # Nothing changes unless the new value works
+        if option == "hash":
+            self.hash_mb = max(1, parse_int(value, "Hash"))
+        elif option in ("book", "bookkeys"):
+            path = value if option == "book" else self.book_path
+            keys_path = value if option == "bookkeys" else self.book_keys_path
+            opening_book = self.open_book(path, keys_path)
+            if self.opening_book != None: self.opening_book.close()
+            self.opening_book, self.book_path, self.book_keys_path = opening_book, path, keys_path
+        elif option == "tablebases":
+            self.tablebases = tablebase.Tablebases(value) if value else None
+        else:
+            return
+        self.engine = None
+
+    # position [startpos | fen <FEN>] [moves <move> ...], with moves in long algebraic notation
+    def set_position(self, args):
+        moves_at = args.index("moves") if "moves" in args else len(args)
+        if args[:1] == ["fen"]: fen = " ".join(args[1:moves_at])
+        else: fen = start_fen
+        try:
+            self.game.load_fen(fen)
+        except ValueError as e:
+            self.send("info string " + str(e))
+            return
+        for name in args[moves_at + 1:]:
+            move = self.parse_move(name)
+            if move == None:
+                self.send("info string illegal move " + name)
+                return
+            self.game.make_move(move)
+
+    def parse_move(self, name):
+        for move in self.game.legal_moves():
+            if move_name(move) == name: return move
+        return None
+
+    # go [depth d] [movetime ms] [nodes n] [wtime ms] [btime ms] [winc ms] [binc ms]
+    #    [movestogo n] [infinite] [ponder]
+    def go(self, args):
+        limits = {}
+        for i, word in enumerate(args):
+            if word in ("depth", "movetime", "nodes", "wtime", "btime", "winc", "binc", "movestogo") and i + 1 < len(args):
+                limits[word] = parse_int(args[i + 1], word)
+        infinite = "infinite" in args
+        ponder = "ponder" in args
+
+        player = self.game.active_player
+        movetime = None
+        if "movetime" in limits:
+            movetime = limits["movetime"] / 1000.0
+        elif player + "time" in limits:
+            movetime = engine.allocate_time(limits[player + "time"] / 1000.0,
+                limits.get(player + "inc", 0) / 1000.0, limits.get("movestogo"))
+
+        # A ponder search has no time limit until ponderhit gives it the move's time
+        self.ponder_movetime = movetime if ponder else None
+        if ponder: movetime = None
+        depth = limits.get("depth", 64)
+        nodes = limits.get("nodes")
+
+        # Infinite and ponder searches hold their bestmove until stop or ponderhit
+        if infinite or ponder: self.release.clear()
+        else: self.release.set()
+        self.search_thread = self.get_engine().start_thread(self.search, self.game.copy(history=True), depth, movetime, nodes)
+
+    def search(self, game, depth, movetime, nodes):
+        result = self.get_engine().search(game, depth, movetime, nodes, self.info)
+        self.release.wait()
+        if result["move"] == None:
+            self.send("bestmove 0000")
+        elif len(result["pv"]) > 1:
+            self.send("bestmove {} ponder {}".format(result["name"], result["pv"][1]))
+        else:
+            self.send("bestmove " + result["name"])
+
+    def info(self, result):
+        score = result["score"]
+        if score > engine.MATE_BOUND: score_text = "mate {}".format((engine.MATE - score + 1) // 2)
+        elif score < -engine.MATE_BOUND: score_text = "mate {}".format(-((engine.MATE + score) // 2))
+        else: score_text = "cp {}".format(score)
+        self.send("info depth {} score {} nodes {} nps {} time {} pv {}".format(result["depth"], score_text,
+            result["nodes"], result["nps"], int(result["time"] * 1000), " ".join(result["pv"])))
+
+    # Stop the search, if there is one, and wait for it to send its bestmove
+    def stop(self):
+        if self.search_thread == None: return
+        self.release.set()
+        self.engine.stop_thread(self.search_thread)
+        self.search_thread = None
+
+    # The opponent played the move being pondered on: carry on as a normal search
+    def ponderhit(self):
+        if self.search_thread == None: return
+        if self.ponder_movetime != None: self.engine.set_movetime(self.ponder_movetime)
+        self.release.set()
+
+    def run(self, lines=sys.stdin):
+        for line in lines:
+            try:
+                if not self.command(line): break
+            except (ValueError, OSError) as e:
+                self.send("info string " + str(e))
+        self.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the engine over the Universal Chess Interface on stdin/stdout")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size in MB")
+    parser.add_argument("--book", type=str, default=None, help="Polyglot opening book to play from first")
+    parser.add_argument("--book-keys", type=str, default=None, help="file of the 781 Polyglot keys for --book")
+    parser.add_argument("--tablebases", type=str, default=None, help="directory of endgame tablebases")
+    parser.add_argument("--backend", type=str, default="bitboard", choices=["mailbox", "bitboard"],
+                        help="move generation backend")
+    args = parser.parse_args()
+
+    UciEngine(hash_mb=args.hash, book_path=args.book, book_keys_path=args.book_keys, tablebase_dir=args.tablebases,
+        backend=args.backend).run()
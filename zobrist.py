@@ -0,0 +1,84 @@
+from array import array
+import random
+
+# Zobrist hashing: a position's key is the XOR of a random 64-bit number for each
+# (colour, kind, square) of its pieces, plus numbers for black to move, the castling
+# rights and the en passant file. Making a move only XORs in and out the numbers
+# which change, so Game keeps its key up to date in set_piece and make_move.
+# The numbers come from a fixed seed, so keys are the same in every process
+# (and can be stored, e.g. in a position index).
+_random = random.Random(0x5EED)
+
+# piece_keys[colour][kind][square], with kinds as in bitboard_logic
+piece_keys = {colour: [[_random.getrandbits(64) for sq in range(64)] for kind in range(6)] for colour in ("w", "b")}
+black_to_move_key = _random.getrandbits(64)
+# One key for each combination of the four castling right flags
+castling_keys = [_random.getrandbits(64) for rights in range(16)]
+ep_file_keys = [_random.getrandbits(64) for c in range(8)]
+
+# Bounds for scores stored in the table
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# A fixed-size table of search results keyed by Zobrist key. Entries live in flat
+# arrays, so the memory used is set when the table is made and never grows. Each
+# key maps to a bucket of two entries: the first keeps the deepest result (unless it
+# is from an older search), the second is always replaced.
+class TranspositionTable:
+    # Bytes per entry: the key, packed move/depth/bound/age, and the score
+    entry_size = 24
+
+    def __init__(self, megabytes=16):
+        entries = max(2, int(megabytes * 1024 * 1024) // self.entry_size)
+        # Round down to a power of two buckets, so the bucket is just the low bits of the key
+        self.buckets = 1 << ((entries // 2).bit_length() - 1)
+        self.mask = self.buckets - 1
+        self.size = self.buckets * 2
+        self.keys = array("Q", bytes(8 * self.size))
+        self.data = array("Q", bytes(8 * self.size))
+        self.scores = array("q", bytes(8 * self.size))
+        self.age = 0
+        self.hits = 0
+        self.probes = 0
+
+    def clear(self):
+        for table in (self.keys, self.data, self.scores):
+            table[:] = array(table.typecode, bytes(8 * self.size))
+        self.age = 0
+        self.hits = 0
+        self.probes = 0
+
+    # Call before each new search, so that entries from older searches are replaced first
+    def new_search(self):
+        self.age = (self.age + 1) & 0xFF
+
+    # Returns (depth, score, bound, move) for the key, or None if it isn't in the table.
+    # Empty entries have data 0, and stored entries never do (see store).
+    def probe(self, key):
+        self.probes += 1
+        i = (key & self.mask) << 1
+        keys = self.keys
+        for slot in (i, i+1):
+            if keys[slot] == key and self.data[slot]:
+                self.hits += 1
+                data = self.data[slot]
+                return (((data >> 18) & 0xFF) - 1, self.scores[slot], (data >> 26) & 3, data & 0x3FFFF)
+        return None
+
+    # move is an encoded move (see bitboard_logic) or 0, and depth is 0-254
+    def store(self, key, depth, score, bound=EXACT, move=0):
+        i = (key & self.mask) << 1
+        data = move | (depth + 1) << 18 | bound << 26 | self.age << 28
+        old = self.data[i]
+        if (self.keys[i] == key or old == 0 or ((old >> 28) & 0xFF) != self.age
+                or depth + 1 >= ((old >> 18) & 0xFF)):
+            slot = i
+        else:
+            slot = i+1
+        self.keys[slot] = key
+        self.data[slot] = data
+        self.scores[slot] = score
+
+    # Roughly how full the table is, in parts per thousand (as in UCI's "hashfull")
+    def hashfull(self):
+        sample = min(1000, self.size)
+        return sum(1 for i in range(sample) if self.data[i] and (self.data[i] >> 28) & 0xFF == self.age) * 1000 // sample